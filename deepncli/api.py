@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming API for junction search and BLAST parsing.
+
+The functions in this module work on any iterable of text lines (open files, pipes, lists, generators) and yield
+hit records as they are found, without reading or writing the work folder layout used by the command line tool.
+"""
+from .junction.proteinprocessor import ProteinProcessor
+from .junction.mismatch import MismatchMatcher
+from .junction.packed import screen_lines
+
+
+class JunctionHit(object):
+    """A read whose junction sequence was found, with the reading frame downstream of the junction."""
+    __slots__ = ('read_name', 'flag', 'reference', 'position', 'sequence', 'downstream', 'protein',
+                 'junction_index', 'match_index', 'mismatches', 'reverse')
+
+    def __init__(self, read_name, flag, reference, position, sequence, downstream, protein,
+                 junction_index, match_index, mismatches, reverse):
+        self.read_name = read_name
+        self.flag = flag
+        self.reference = reference
+        self.position = position
+        self.sequence = sequence
+        self.downstream = downstream
+        self.protein = protein
+        self.junction_index = junction_index
+        self.match_index = match_index
+        self.mismatches = mismatches
+        self.reverse = reverse
+
+    def junction_line(self):
+        """The line written for this hit to a .junctions.txt file."""
+        return "%s %s %s %s %s %s %s %d\n" % (self.read_name, self.flag, self.reference, self.position,
+                                              self.sequence, self.downstream, self.protein, self.mismatches)
+
+    def fasta_record(self):
+        """The BLAST query written for this hit to a .junctions.fa file."""
+        return ">%s\n%s\n" % (self.read_name, self.downstream)
+
+    def __repr__(self):
+        return "JunctionHit(%s, mismatches=%d)" % (self.read_name, self.mismatches)
+
+
+class BlastHit(object):
+    """An accepted BLAST alignment of a junction read against a gene, with its frame and ORF classification."""
+    __slots__ = ('query', 'nm_number', 'gene', 'identity', 'bitscore', 'position', 'query_start', 'frame', 'orf')
+
+    def __init__(self, query, nm_number, gene, identity, bitscore, position, query_start, frame, orf):
+        self.query = query
+        self.nm_number = nm_number
+        self.gene = gene
+        self.identity = identity
+        self.bitscore = bitscore
+        self.position = position
+        self.query_start = query_start
+        self.frame = frame
+        self.orf = orf
+
+    @property
+    def inframe_inorf(self):
+        return self.frame == 'in_frame' and self.orf == 'in_orf'
+
+    def __repr__(self):
+        return "BlastHit(%s, %s, %d, %s, %s)" % (self.query, self.gene, self.position, self.frame, self.orf)
+
+
+class BlastParseCounts(object):
+    """Running totals of a BLAST parse: queries seen, hits accepted and lines rejected."""
+    __slots__ = ('queries', 'accepted', 'rejected')
+
+    def __init__(self):
+        self.queries = 0
+        self.accepted = 0
+        self.rejected = 0
+
+
+def make_search_junctions(junctions_array):
+    junction_sequences = []
+    for junc in junctions_array:
+        junction_sequences.append(junc[30:50])
+        junction_sequences.append(junc[26:46])
+        junction_sequences.append(junc[22:42])
+    return junction_sequences
+
+
+def junctions_in_read(read, junction_sequences):
+    match_index = -1
+    junction_index = -1
+    for i, j in enumerate(junction_sequences):
+        if j in read:
+            match_index = read.index(j)
+            junction_index = i
+    return junction_index, match_index
+
+
+def search_junctions(reads, search_sequences, exclusion_sequence='', max_mismatches=0, engine='text'):
+    """Like `iter_junctions` but takes the 20-mer search sequences made by `make_search_junctions`."""
+    if engine == 'packed':
+        reads = screen_lines(reads, search_sequences, max_mismatches)
+    processor = ProteinProcessor()
+    matcher = MismatchMatcher(search_sequences, max_mismatches) if max_mismatches else None
+    exclusion_sequence = exclusion_sequence.upper() if exclusion_sequence else ''
+
+
+    def make_hit(l, indexes, read, reverse):
+        if indexes[0] != -1:
+            junction = search_sequences[indexes[0]]
+            downstream_rf = read[len(junction) + indexes[1] + (indexes[0] % 3) * 4:]
+            if len(downstream_rf) > 25:
+                if exclusion_sequence not in downstream_rf or exclusion_sequence == '':
+                    return JunctionHit(l[0], l[1], l[2], l[3], l[9], downstream_rf,
+                                       processor.translate_orf(downstream_rf), indexes[0], indexes[1], indexes[2],
+                                       reverse)
+        return None
+
+    for line in reads:
+        line_split = line.strip().split()
+        if len(line_split) and line_split[0][0] != "@" and line_split[2] == "*":
+            sequence_read = line_split[9]
+            indexes = junctions_in_read(sequence_read, search_sequences) + (0,)
+            hit = make_hit(line_split, indexes, sequence_read, False)
+            if hit is None:
+                rev_sequence_read = processor.reverse_complement(sequence_read)
+                rev_indexes = junctions_in_read(rev_sequence_read, search_sequences) + (0,)
+                hit = make_hit(line_split, rev_indexes, rev_sequence_read, True)
+                # approximate matches only when neither orientation contains an exact junction
+                if hit is None and matcher and indexes[0] == -1 and rev_indexes[0] == -1:
+                    hit = make_hit(line_split, matcher.search(sequence_read), sequence_read, False)
+                    if hit is None:
+                        hit = make_hit(line_split, matcher.search(rev_sequence_read), rev_sequence_read, True)
+            if hit is not None:
+                yield hit
+
+
+def iter_junctions(reads, junction_sequences, exclusion_sequence='', max_mismatches=0, engine='text'):
+    """Yields a `JunctionHit` for every unmapped SAM record in reads that contains one of the junction sequences.
+
+    junction_sequences are the 50 bp vector/insert junctions (as in `deepn junction_make --seq`); reads whose
+    downstream sequence contains exclusion_sequence are skipped and up to max_mismatches substitutions are allowed
+    in the junction. engine='packed' screens the reads in NumPy batches first (requires numpy).
+    """
+    return search_junctions(reads, make_search_junctions(junction_sequences), exclusion_sequence, max_mismatches,
+                            engine)
+
+
+def gene_list_entry(split):
+    """[gene name, orf start, orf stop, intron flag] from the fields of a gene list (.prn) line."""
+    return [split[1], int(split[6]) + 1, int(split[7]), split[8]]
+
+
+def read_gene_list(lines):
+    """Reads a gene list (.prn) into the {nm_number: gene_list_entry} dictionary used by `iter_blast_hits`."""
+    gene_dictionary = {}
+    for line in lines:
+        split = line.split()
+        gene_dictionary[split[0]] = gene_list_entry(split)
+    return gene_dictionary
+
+
+def classify_hit(gene_entry, position, query_start, subject_end):
+    """Returns the (frame, orf) labels of a junction at position of a gene."""
+    fudge_factor = query_start - 1
+    _frame = position - gene_entry[1] - fudge_factor
+    # Frame Calculation
+    frame = "not_in_frame"
+    if _frame % 3 == 0 or _frame == 0:
+        frame = "in_frame"
+    if gene_entry[3] == "INTRON":
+        frame = "intron"
+    if subject_end - position < 0:
+        frame = "backwards"
+    # Orf calculation
+    orf = "in_orf"
+    if position < gene_entry[1]:
+        orf = "upstream"
+    if position > gene_entry[2]:
+        orf = "downstream"
+    return frame, orf
+
+
+def iter_accepted_alignments(stream, counts=None):
+    """Yields the split fields of every accepted alignment in BLAST tabular output with comments (-outfmt 7).
+
+    Hits need more than 98% identity and a bitscore above 50 and within 2% of the previous accepted hit of the
+    same query; queries with more than 100 hits are skipped. Pass a `BlastParseCounts` to collect totals.
+    """
+    counts = counts if counts is not None else BlastParseCounts()
+    previous_bitscore = 0
+    collect_results = True
+    for line in stream:
+        split = line.split()
+        if "BLASTN" in line:
+            previous_bitscore = 0
+            collect_results = True
+            counts.queries += 1
+
+        elif "hits" in line and int(split[1]) > 100:
+            collect_results = False
+
+        elif split[0] != '#' and collect_results and float(split[2]) > 98 and float(split[11]) > 50.0 and \
+                float(split[11]) > previous_bitscore:
+            counts.accepted += 1
+            previous_bitscore = float(split[11]) * 0.98
+            yield split
+        else:
+            counts.rejected += 1
+
+
+def iter_blast_hits(stream, gene_dictionary, counts=None):
+    """Yields a `BlastHit` for every alignment accepted by `iter_accepted_alignments`."""
+    for split in iter_accepted_alignments(stream, counts):
+        nm_number = split[1]
+        position = int(split[8])
+        query_start = int(split[6])
+        gene_entry = gene_dictionary[nm_number]
+        frame, orf = classify_hit(gene_entry, position, query_start, int(split[9]))
+        yield BlastHit(split[0], nm_number, gene_entry[0], float(split[2]), float(split[11]), position, query_start,
+                       frame, orf)
@@ -2,14 +2,25 @@
 
 """Console script for deepncli."""
 # project imports
-from .utils.io import check_and_create_folders
+from .utils.io import check_and_create_folders, compression_available, get_sam_filelist
 from .utils.download import download_data
+from .utils.resources import CoreBudget, affinity_supported
+from .utils.time import elapsed_time
 import joblib.parallel as parallel
-from .junction.main import junction_search, blast_search, parse_blast_results
+from .junction.main import junction_search, blast_search, parse_blast_results, stream_sample
+from .junction.detect import detect_junction as find_junction, report_detection, check_junction_sequence
+from .junction.packed import packed_available
+from .junction.mismatch import MAX_MISMATCHES
+from .junction.preview import preview_folder, subsample_samples, preview_report
+from .junction.distributed import submit_samples, wait_for_samples, merge_results, run_worker
+from .junction.server import server_socket, server_running, send_command, run_server, submit_to_server, wait_for_jobs
+from .compare.main import compare_samples
+from .query.main import query_gene
 # from .genecount.main import count_genes
 # Library imports
 import os
 import sys
+import time
 import click
 from functools import partial
 import warnings
@@ -58,6 +69,22 @@ junction_sequences = {'hg38': "CCTCTGCGAGTGGTGGCAACTCTGTGGCCGGCCCAGCCGGCCATGTCAG
                       'hg38_pGAD': "AATTCCACCCAAGCAGTGGTATCAACGCAGAGTGGCCATTACGGCCGGGG"}
 
 
+def report_utilisation(budget, start):
+    wall_time = time.time() - start
+    hr, min, sec = elapsed_time(start, time.time())
+    click.echo(cyan_fg("\n>>> Core utilisation for a budget of %d cores over %d hr, %d min, %d sec:"
+                       % (budget.cores, hr, min, sec)))
+    for stage, core_seconds, utilisation in budget.report(wall_time):
+        click.echo(yellow_fg("    %-8s %10.1f core-sec  %5.1f%%" % (stage, core_seconds, utilisation * 100)))
+    budget.close()
+
+
+def warn_unpinned(pin):
+    if pin and not affinity_supported():
+        click.echo(red_fg(">>> WARNING: CPU affinity needs python 3 on Linux or psutil with cpu_affinity (not on "
+                          "macOS), only blastn will be pinned (through taskset when available)."))
+
+
 def verify_options(*args, **kwargs):
     if not kwargs['genome'] in blast_dbs.keys():
         click.echo(red_fg(">>> ERROR: Specified option for genome selection (%s) not available" % kwargs['genome']))
@@ -65,6 +92,51 @@ def verify_options(*args, **kwargs):
     if not os.path.exists(kwargs['dir']):
         click.echo(red_fg(">>> ERROR: Specified work folder (%s) does not exist." % kwargs['dir']))
         sys.exit(1)
+    warn_unpinned(kwargs['pin'])
+    if not compression_available(kwargs['compress']):
+        click.echo(red_fg(">>> ERROR: Compression (%s) requires the zstandard package." % kwargs['compress']))
+        sys.exit(1)
+    if kwargs['engine'] == 'packed' and not packed_available():
+        click.echo(red_fg(">>> ERROR: The packed search engine requires the numpy package."))
+        sys.exit(1)
+    if not 0 <= kwargs['max_mismatches'] <= MAX_MISMATCHES:
+        click.echo(red_fg(">>> ERROR: Number of mismatches (%d) should be between 0 and %d."
+                          % (kwargs['max_mismatches'], MAX_MISMATCHES)))
+        sys.exit(1)
+    if kwargs['sample_fraction'] is not None and not 0 < kwargs['sample_fraction'] <= 1:
+        click.echo(red_fg(">>> ERROR: Sample fraction (%s) should be between 0 and 1." % kwargs['sample_fraction']))
+        sys.exit(1)
+    if kwargs['max_reads'] is not None and kwargs['max_reads'] < 1:
+        click.echo(red_fg(">>> ERROR: Maximum number of reads (%d) should be at least 1." % kwargs['max_reads']))
+        sys.exit(1)
+    if kwargs['sample_fraction'] is not None and kwargs['max_reads'] is not None:
+        click.echo(red_fg(">>> ERROR: Use either --sample_fraction or --max_reads for a preview, not both."))
+        sys.exit(1)
+    if (kwargs['sample_fraction'] is not None or kwargs['max_reads'] is not None) and kwargs['distributed']:
+        click.echo(red_fg(">>> ERROR: Preview runs (--sample_fraction/--max_reads) can not be distributed."))
+        sys.exit(1)
+    if kwargs['stdin'] and kwargs['sample'] == "":
+        click.echo(red_fg(">>> ERROR: A sample name (--sample) is needed to read SAM records from stdin."))
+        sys.exit(1)
+    if kwargs['stdin'] and kwargs['follow']:
+        click.echo(red_fg(">>> ERROR: Use either --stdin or --follow, not both."))
+        sys.exit(1)
+    if (kwargs['stdin'] or kwargs['follow']) and (kwargs['distributed'] or kwargs['interactive'] or
+                                                   kwargs['sample_fraction'] is not None or
+                                                   kwargs['max_reads'] is not None):
+        click.echo(red_fg(">>> ERROR: Streaming input (--stdin/--follow) can not be combined with --distributed, "
+                          "--interactive or a preview."))
+        sys.exit(1)
+    if kwargs['tier_report'] and kwargs['first_pass'] == 'none':
+        click.echo(red_fg(">>> ERROR: The tier report (--tier_report) needs a first pass (--first_pass)."))
+        sys.exit(1)
+    if kwargs['server'] and (kwargs['distributed'] or kwargs['interactive'] or kwargs['stdin'] or kwargs['follow']):
+        click.echo(red_fg(">>> ERROR: Jobs submitted to a server (--server) can not be combined with --distributed, "
+                          "--interactive or streaming input."))
+        sys.exit(1)
+    if kwargs['server'] and not server_running(kwargs['server']):
+        click.echo(red_fg(">>> ERROR: No server answers on %s. Start one with: deepn serve" % kwargs['server']))
+        sys.exit(1)
 
 
 @click.group()
@@ -98,16 +170,59 @@ def initialize(config, *args, **kwargs):
                                               "options: mm10/hg38/saccer3/hg38_pGAD/saccer3_pGAD")
 @deepn_option("--seq", required=False, default="", help="junction sequence used in sequencing. "
                                                         "If provided default junction sequence will be ignored")
-@deepn_option("--threads", required=False, help="Number of threads to use for processing the files. "
-                                                "Defaults to the number of processors.")
+@deepn_option("--threads", required=False, type=int, help="Number of threads to use for processing the files. "
+                                                          "Defaults to the core budget.")
+@deepn_option("--cores", required=False, type=int, help="core budget shared by the search/parse workers and blastn. "
+                                                        "Defaults to the number of processors.")
+@deepn_option("--pin", is_flag=True, help="if enabled, workers and blastn are pinned to the cores they hold")
+@deepn_option("--parse_memory", required=False, default=1024, type=int,
+              help="memory limit (in MB) for junction aggregation in each parse worker. "
+                   "Larger samples are spilled to disk in the blast_results_query folder.")
+@deepn_option("--max_mismatches", required=False, default=0, type=int,
+              help="number of mismatches allowed when matching the junction sequence in a read (0-2, "
+                   "more would make the search many times slower). The mismatch count of each hit is reported in the last column of the junction files.")
+@deepn_option("--engine", required=False, default='text', type=click.Choice(['text', 'packed']),
+              help="junction search engine. packed screens batches of reads for junction seeds with NumPy "
+                   "before the exact search (requires numpy)")
+@deepn_option("--first_pass", required=False, default='none', type=click.Choice(['none', 'megablast', 'dc-megablast']),
+              help="BLAST task of a fast first pass; only the junctions without an accepted hit are blasted again "
+                   "with the sensitive blastn settings")
+@deepn_option("--tier_report", is_flag=True, help="if enabled, the junctions are also blasted in a single sensitive "
+                                                  "pass and the accepted hits of both are compared in "
+                                                  "blast_results/<sample>.tier_report.tsv")
+@deepn_option("--compress", required=False, default='none', type=click.Choice(['none', 'gzip', 'zstd']),
+              help="compression of the junction tables written to junction_files")
+@deepn_option("--sample_fraction", required=False, type=float,
+              help="preview mode: fraction (0-1) of the reads of each .sam file to sample. The subsample is processed "
+                   "into preview_ folders and an approximate per-gene ppm report is written.")
+@deepn_option("--max_reads", required=False, type=int,
+              help="preview mode: number of reads to sample from each .sam file")
 @deepn_option("--exclude_seq", required=False, default="", help="sequence to exclude from junction matching")
+@deepn_option("--stdin", is_flag=True, help="if enabled, SAM records are read from stdin (e.g. piped from the "
+                                            "aligner) for the sample named with --sample. Junctions are piped to BLAST "
+                                            "while the search runs.")
+@deepn_option("--sample", required=False, default="", help="sample name used for the output files with --stdin")
+@deepn_option("--follow", is_flag=True, help="if enabled, the .sam files are read while the aligner is still writing "
+                                             "them, one after the other, and junctions are piped to BLAST while the "
+                                             "search runs")
+@deepn_option("--follow_timeout", required=False, default=60, type=int,
+              help="seconds without new data after which a followed .sam file is considered complete")
+@deepn_option("--skip_detect", is_flag=True, help="if enabled, the junction sequence is not checked against the "
+                                                  "first reads of each .sam file before the search")
 @deepn_option("--unmapped", is_flag=True, help="if flag is enabled, .sam files will "
                                                "be read from unmapped_sam_files folder")
 @deepn_option("--interactive", is_flag=True, help="if enabled interactive session will be turned on.")
+@deepn_option("--distributed", is_flag=True, help="if enabled, samples are queued in the work folder and processed by "
+                                                  "`deepn worker` processes on any node sharing the folder.")
+@deepn_option("--server", required=False, default="", help="socket of a running `deepn serve`; the samples are "
+                                                           "processed by the server instead of this process")
+@deepn_option("--lease_timeout", required=False, default=600, type=int,
+              help="seconds without a heartbeat after which a distributed sample is handed to another worker")
 @pass_config
 def junction_make(config, *args, **kwargs):
     click.echo(green_fg("\n{}  Junction Make  {}\n".format(">" * 10, "<" * 10)))
-    threads = kwargs['threads'] if kwargs['threads'] else parallel.cpu_count()
+    cores = min(kwargs['cores'], parallel.cpu_count()) if kwargs['cores'] else parallel.cpu_count()
+    threads = min(kwargs['threads'], cores) if kwargs['threads'] else cores
     input_data_folder = 'unmapped_sam_files' if kwargs['unmapped'] else 'sam_files'
     junction_folder = 'junction_files'  # Manage name of junction reads output folder here
     blast_results_folder = 'blast_results'  # Manage name of blast results output folder here
@@ -120,33 +235,208 @@ def junction_make(config, *args, **kwargs):
     gene_list_file = gene_lists[kwargs['genome']]
     # verify if the options provided are valid
     verify_options(*args, **kwargs)
+    streaming = kwargs['stdin'] or kwargs['follow']
+    if not kwargs['skip_detect'] and not streaming:
+        # check the junction sequence on the first reads instead of failing after the search
+        check_junction_sequence([os.path.join(kwargs['dir'], input_data_folder, f)
+                                 for f in sorted(get_sam_filelist(kwargs['dir'], input_data_folder))],
+                                junction_sequence, junction_sequences)
+    preview = kwargs['sample_fraction'] is not None or kwargs['max_reads'] is not None
+    if preview:
+        junction_folder = preview_folder(junction_folder)
+        blast_results_folder = preview_folder(blast_results_folder)
+        blast_results_query = preview_folder(blast_results_query)
     # create folders for junction make
-    check_and_create_folders(kwargs['dir'], ['junction_files', 'blast_results', 'blast_results_query'],
+    check_and_create_folders(kwargs['dir'], [junction_folder, blast_results_folder, blast_results_query],
                              interactive=kwargs['interactive'])
+    if preview:
+        check_and_create_folders(kwargs['dir'], [preview_folder(input_data_folder)])
+        click.echo(cyan_fg("\n>>> Preview mode: results are approximate and written to the preview_ folders."))
+        input_data_folder = subsample_samples(kwargs['dir'], input_data_folder, kwargs['sample_fraction'],
+                                              kwargs['max_reads'])
+    settings = {'input_data_folder': input_data_folder, 'junction_folder': junction_folder,
+                'blast_results_folder': blast_results_folder, 'blast_results_query_folder': blast_results_query,
+                'junction_sequence': junction_sequence, 'exclusion_sequence': exclusion_sequence,
+                'max_mismatches': kwargs['max_mismatches'], 'compression': kwargs['compress'],
+                'blast_db': blast_db, 'gene_list_file': gene_list_file, 'parse_memory': kwargs['parse_memory'],
+                'lease_timeout': kwargs['lease_timeout'], 'engine': kwargs['engine'],
+                'first_pass': kwargs['first_pass'], 'tier_report': kwargs['tier_report']}
+    if kwargs['distributed']:
+        submit_samples(kwargs['dir'], settings)
+        wait_for_samples(kwargs['dir'])
+        if len(merge_results(kwargs['dir'])):
+            sys.exit(1)
+        return
+    if kwargs['server']:
+        failed = wait_for_jobs(kwargs['server'], submit_to_server(kwargs['server'], kwargs['dir'], settings))
+        if preview and not len(failed):
+            preview_report(kwargs['dir'], input_data_folder, blast_results_query)
+        if len(failed):
+            sys.exit(1)
+        return
+    start = time.time()
+    budget = CoreBudget(cores, pin=kwargs['pin'])
+    if streaming:
+        if kwargs['stdin']:
+            stream_sample(kwargs['dir'], settings, kwargs['sample'], '-', budget)
+        else:
+            sam_files = sorted(get_sam_filelist(kwargs['dir'], input_data_folder))
+            if not len(sam_files):
+                click.echo(red_fg("\n>>> ERROR: No .sam files found in directory %s." % kwargs['dir']))
+                sys.exit(1)
+            for f in sam_files:
+                stream_sample(kwargs['dir'], settings, os.path.splitext(f)[0],
+                              os.path.join(kwargs['dir'], input_data_folder, f), budget, kwargs['follow_timeout'])
+        report_utilisation(budget, start)
+        return
     if kwargs['interactive']:
         if not click.confirm(magenta_fg('\nDo you want to search junctions and blast?')):
             click.echo(red_fg("...Skipping search junctions and blast..."))
         else:
             # search for junctions
             junction_search(kwargs['dir'], junction_folder, input_data_folder, blast_results_folder,
-                            junction_sequence, exclusion_sequence, threads)
+                            junction_sequence, exclusion_sequence, threads, kwargs['max_mismatches'],
+                            kwargs['compress'], budget, kwargs['engine'])
             # blast the junctions
-            blast_search(kwargs['dir'], blast_db, blast_results_folder)
+            blast_search(kwargs['dir'], blast_db, blast_results_folder, budget, kwargs['first_pass'],
+                         kwargs['tier_report'])
 
         if not click.confirm(magenta_fg('\nDo you want to parse blast results')):
             click.echo(red_fg("ABORTING..."))
             sys.exit(1)
         else:
             # parse blast results
-            parse_blast_results(kwargs['dir'], blast_results_folder, blast_results_query, gene_list_file, threads)
+            parse_blast_results(kwargs['dir'], blast_results_folder, blast_results_query, gene_list_file, threads,
+                                kwargs['parse_memory'], budget)
     else:
         # search for junctions
         junction_search(kwargs['dir'], junction_folder, input_data_folder, blast_results_folder,
-                        junction_sequence, exclusion_sequence, threads)
+                        junction_sequence, exclusion_sequence, threads, kwargs['max_mismatches'],
+                        kwargs['compress'], budget, kwargs['engine'])
         # blast the junctions
-        blast_search(kwargs['dir'], blast_db, blast_results_folder)
+        blast_search(kwargs['dir'], blast_db, blast_results_folder, budget, kwargs['first_pass'], kwargs['tier_report'])
         # parse blast results
-        parse_blast_results(kwargs['dir'], blast_results_folder, blast_results_query, gene_list_file, threads)
+        parse_blast_results(kwargs['dir'], blast_results_folder, blast_results_query, gene_list_file, threads,
+                            kwargs['parse_memory'], budget)
+    if preview:
+        preview_report(kwargs['dir'], input_data_folder, blast_results_query)
+    report_utilisation(budget, start)
+
+
+@main.command()
+@deepn_option("--dir", required=True, help="path to work folder")
+@deepn_option("--reads", required=False, default=200000, type=int,
+              help="number of unmapped reads read from the start of each .sam file")
+@deepn_option("--unmapped", is_flag=True, help="if flag is enabled, .sam files will "
+                                               "be read from unmapped_sam_files folder")
+@pass_config
+def detect_junction(config, *args, **kwargs):
+    click.echo(green_fg("\n{}  Detect Junction  {}\n".format(">" * 10, "<" * 10)))
+    input_data_folder = 'unmapped_sam_files' if kwargs['unmapped'] else 'sam_files'
+    sam_files = sorted(get_sam_filelist(kwargs['dir'], input_data_folder))
+    if not len(sam_files):
+        click.echo(red_fg("\n>>> ERROR: No .sam files found in directory %s." % kwargs['dir']))
+        sys.exit(1)
+    for f in sam_files:
+        report_detection(f, find_junction(os.path.join(kwargs['dir'], input_data_folder, f), junction_sequences,
+                                          kwargs['reads']))
+
+
+@main.command()
+@deepn_option("--dir", required=True, help="path to work folder")
+@deepn_option("--selected", required=False, default="", help="comma separated names of the selected samples "
+                                                             "(database names in blast_results_query without .db). "
+                                                             "All other samples are treated as non-selected.")
+@deepn_option("--pseudocount", required=False, default=1.0, type=float,
+              help="ppm added to both populations when computing enrichment ratios")
+@pass_config
+def compare(config, *args, **kwargs):
+    click.echo(green_fg("\n{}  Compare  {}\n".format(">" * 10, "<" * 10)))
+    blast_results_query = 'blast_results_query'  # Manage name of blast results dictionary output folder here
+    compare_folder = 'compare'  # Manage name of sample comparison output folder here
+    if not os.path.exists(os.path.join(kwargs['dir'], blast_results_query)):
+        click.echo(red_fg(">>> ERROR: Folder (%s) does not exist in work folder (%s). "
+                          "Run junction_make first." % (blast_results_query.upper(), kwargs['dir'])))
+        sys.exit(1)
+    selected = [s for s in kwargs['selected'].replace(" ", "").split(",") if s != ""]
+    check_and_create_folders(kwargs['dir'], [compare_folder])
+    compare_samples(kwargs['dir'], blast_results_query, compare_folder, selected, kwargs['pseudocount'])
+
+
+@main.command()
+@deepn_option("--dir", required=True, help="path to work folder")
+@deepn_option("--gene", required=True, help="gene name or NM number to look up")
+@deepn_option("--summary", is_flag=True, help="if enabled only the gene stats of each sample are shown")
+@pass_config
+def query(config, *args, **kwargs):
+    blast_results_query = 'blast_results_query'  # Manage name of blast results dictionary output folder here
+    compare_folder = 'compare'  # Manage name of sample comparison output folder here
+    if not os.path.exists(os.path.join(kwargs['dir'], blast_results_query)):
+        click.echo(red_fg(">>> ERROR: Folder (%s) does not exist in work folder (%s). "
+                          "Run junction_make first." % (blast_results_query.upper(), kwargs['dir'])))
+        sys.exit(1)
+    query_gene(kwargs['dir'], blast_results_query, compare_folder, kwargs['gene'], not kwargs['summary'])
+
+
+@main.command()
+@deepn_option("--dir", required=True, help="path to work folder")
+@deepn_option("--wait", is_flag=True, help="keep polling until every queued sample is finished, taking over samples "
+                                           "from workers that stop sending heartbeats")
+@deepn_option("--cores", required=False, type=int, help="core budget of this worker. "
+                                                        "Defaults to the number of processors.")
+@deepn_option("--pin", is_flag=True, help="if enabled, the worker and blastn are pinned to the cores they hold")
+@pass_config
+def worker(config, *args, **kwargs):
+    click.echo(green_fg("\n{}  Worker  {}\n".format(">" * 10, "<" * 10)))
+    warn_unpinned(kwargs['pin'])
+    start = time.time()
+    budget = CoreBudget(kwargs['cores'] if kwargs['cores'] else parallel.cpu_count(), pin=kwargs['pin'])
+    run_worker(kwargs['dir'], kwargs['wait'], budget=budget)
+    report_utilisation(budget, start)
+
+
+@main.command()
+@deepn_option("--socket", required=False, default=server_socket, help="path of the Unix socket to serve on")
+@deepn_option("--genome", required=False, default="hg38", help="comma separated reference organisms whose gene "
+                                                                "lists and BLAST databases are loaded at start")
+@deepn_option("--workers", required=False, type=int, help="number of samples processed at the same time. "
+                                                          "Defaults to the core budget.")
+@deepn_option("--cores", required=False, type=int, help="core budget shared by the jobs and blastn. "
+                                                        "Defaults to the number of processors.")
+@deepn_option("--pin", is_flag=True, help="if enabled, workers and blastn are pinned to the cores they hold")
+@deepn_option("--status", is_flag=True, help="if enabled, the metrics of the running server are shown")
+@deepn_option("--stop", is_flag=True, help="if enabled, the running server is stopped after its current jobs")
+@pass_config
+def serve(config, *args, **kwargs):
+    click.echo(green_fg("\n{}  Serve  {}\n".format(">" * 10, "<" * 10)))
+    if kwargs['status'] or kwargs['stop']:
+        if not server_running(kwargs['socket']):
+            click.echo(red_fg(">>> ERROR: No server answers on %s." % kwargs['socket']))
+            sys.exit(1)
+        metrics = send_command(kwargs['socket'], 'ping')
+        click.echo(cyan_fg(">>> Server pid %d up for %.0f sec with %d workers" % (metrics['pid'], metrics['uptime'],
+                                                                                 metrics['workers'])))
+        click.echo(yellow_fg("    jobs: %s" % (", ".join("%s %d" % item for item in sorted(metrics['jobs'].items()))
+                                                 or "none")))
+        for stage, seconds in sorted(metrics['mean_stage_seconds'].items()):
+            click.echo(yellow_fg("    %-8s %8.1f sec per sample" % (stage, seconds)))
+        click.echo(yellow_fg("    gene lists: %s" % ", ".join(metrics['gene_lists'])))
+        if kwargs['stop']:
+            send_command(kwargs['socket'], 'shutdown')
+            click.echo(green_fg(">>> Stopping the server on %s." % kwargs['socket']))
+        return
+    genomes = [g for g in kwargs['genome'].replace(" ", "").split(",") if g != ""]
+    for genome in genomes:
+        if genome not in blast_dbs.keys():
+            click.echo(red_fg(">>> ERROR: Specified option for genome selection (%s) not available" % genome))
+            sys.exit(1)
+    cores = min(kwargs['cores'], parallel.cpu_count()) if kwargs['cores'] else parallel.cpu_count()
+    warn_unpinned(kwargs['pin'])
+    start = time.time()
+    budget = CoreBudget(cores, pin=kwargs['pin'])
+    run_server(kwargs['socket'], [(gene_lists[g], blast_dbs[g]) for g in genomes],
+               kwargs['workers'] or cores, budget)
+    report_utilisation(budget, start)
 
 
 # @main.command()
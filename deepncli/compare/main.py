@@ -0,0 +1,104 @@
+# project imports
+from ..db.experimentdb import ExperimentDatabase, Sample
+from ..utils.io import get_file_list
+from ..utils.time import elapsed_time
+# Other imports
+import os
+import sys
+import time
+import click
+from tqdm import tqdm
+from functools import partial
+from itertools import groupby
+import warnings
+warnings.filterwarnings("ignore")
+
+
+green_fg = partial(click.style, fg='green')
+yellow_fg = partial(click.style, fg='yellow')
+magenta_fg = partial(click.style, fg='magenta')
+cyan_fg = partial(click.style, fg='cyan')
+red_fg = partial(click.style, fg='red')
+
+gene_ppm_query = ("SELECT j.gene_name, j.sample_id, SUM(j.count) * 1000000.0 / s.blast_count "
+                  "FROM sample_junction j JOIN sample s ON s.id = j.sample_id "
+                  "GROUP BY j.gene_name, j.sample_id ORDER BY j.gene_name")
+
+junction_ppm_query = ("SELECT j.gene_name, j.nm_number, j.position, j.query_start, j.frame, j.orf, j.sample_id, "
+                      "SUM(j.count) * 1000000.0 / s.blast_count "
+                      "FROM sample_junction j JOIN sample s ON s.id = j.sample_id "
+                      "GROUP BY j.gene_name, j.nm_number, j.position, j.query_start, j.frame, j.orf, j.sample_id "
+                      "ORDER BY j.gene_name, j.nm_number, j.position, j.query_start, j.frame, j.orf")
+
+
+def enrichment(ppms, selected_columns, non_selected_columns, pseudocount):
+    selected_ppm = sum(ppms[i] for i in selected_columns) / len(selected_columns)
+    non_selected_ppm = sum(ppms[i] for i in non_selected_columns) / len(non_selected_columns)
+    return [selected_ppm, non_selected_ppm, (selected_ppm + pseudocount) / (non_selected_ppm + pseudocount)]
+
+
+def write_matrix(db, query, key_names, samples, output_path, pseudocount):
+    """Pivots (key..., sample_id, ppm) rows of an aggregate query into one row per key and a column per sample."""
+    columns = dict((sample.id, i) for i, sample in enumerate(samples))
+    selected_columns = [i for i, sample in enumerate(samples) if sample.selected]
+    non_selected_columns = [i for i, sample in enumerate(samples) if not sample.selected]
+    compute_enrichment = len(selected_columns) > 0 and len(non_selected_columns) > 0
+    header = key_names + [sample.name for sample in samples]
+    if compute_enrichment:
+        header += ['selected_ppm', 'non_selected_ppm', 'enrichment']
+    rows = 0
+    output_handle = open(output_path, 'w')
+    output_handle.write("\t".join(header) + "\n")
+    key_length = len(key_names)
+    for key, group in groupby(db.execute_sql(query), key=lambda row: row[:key_length]):
+        ppms = [0.0] * len(samples)
+        for row in group:
+            ppms[columns[row[key_length]]] = row[key_length + 1] or 0.0
+        if compute_enrichment:
+            ppms += enrichment(ppms, selected_columns, non_selected_columns, pseudocount)
+        output_handle.write("\t".join([str(k) for k in key] + ["%.4f" % p for p in ppms]) + "\n")
+        rows += 1
+    output_handle.close()
+    return rows
+
+
+def compare_samples(directory, blast_results_query_folder, compare_folder, selected, pseudocount):
+    start = time.time()
+    sample_files = sorted(get_file_list(directory, blast_results_query_folder, ".db"))
+    if not len(sample_files):
+        click.echo(red_fg("\n>>> ERROR: No sample databases found in folder %s." % blast_results_query_folder))
+        sys.exit(1)
+    sample_names = [os.path.splitext(f)[0] for f in sample_files]
+    unknown = [s for s in selected if s not in sample_names]
+    if len(unknown):
+        click.echo(red_fg("\n>>> ERROR: Selected samples (%s) not found in folder %s."
+                          % (", ".join(unknown), blast_results_query_folder)))
+        sys.exit(1)
+    store_path = os.path.join(directory, compare_folder, "experiment.db")
+    click.echo(magenta_fg("\n>>> Merging %d sample databases into %s ..." % (len(sample_files), store_path)))
+    edb = ExperimentDatabase(store_path)
+    edb.create_tables()
+    for name, sample_file in tqdm(zip(sample_names, sample_files), total=len(sample_files), unit=" samples",
+                                  desc="Merge",
+                                  bar_format="{desc}: {percentage:3.0f}% | elapsed: {elapsed}, "
+                                             "remaining: {remaining} | {rate_fmt}{postfix}"):
+        edb.add_sample(name, os.path.join(directory, blast_results_query_folder, sample_file), name in selected)
+    edb.create_indexes()
+    edb.analyze()
+    samples = list(Sample.select().order_by(Sample.name))
+    for sample in samples:
+        label = "selected" if sample.selected else "non-selected"
+        click.echo(yellow_fg("    %s (%s): %d blast queries" % (sample.name, label, sample.blast_count)))
+    if not len(selected) or len(selected) == len(samples):
+        click.echo(red_fg("\n>>> WARNING: Need both selected and non-selected samples to compute enrichment."))
+    click.echo(green_fg("\n>>> Writing gene and junction ppm matrices ..."))
+    genes = write_matrix(edb.db, gene_ppm_query, ['gene_name'], samples,
+                         os.path.join(directory, compare_folder, "gene_ppm.txt"), pseudocount)
+    junctions = write_matrix(edb.db, junction_ppm_query,
+                             ['gene_name', 'nm_number', 'position', 'query_start', 'frame', 'orf'], samples,
+                             os.path.join(directory, compare_folder, "junction_ppm.txt"), pseudocount)
+    edb.close_db()
+    finish = time.time()
+    hr, min, sec = elapsed_time(start, finish)
+    click.echo(cyan_fg("\nCompared %d genes and %d junctions across %d samples in time %d hr, %d min, %d sec"
+                       % (genes, junctions, len(samples), hr, min, sec)))
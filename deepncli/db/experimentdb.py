@@ -0,0 +1,89 @@
+from peewee import *
+from playhouse.apsw_ext import APSWDatabase
+from playhouse.migrate import SqliteMigrator, migrate
+
+
+database = APSWDatabase(None, pragmas={'journal_mode': 'off',
+                                       'cache_size': -500*1000,
+                                       'synchronous': 0,
+                                       'foreign_keys': 1,
+                                       'temp_store': 'memory'})  # Un-initialized database.
+
+
+class Sample(Model):
+    name = TextField(unique=True)
+    selected = BooleanField(default=False)
+    blast_count = IntegerField()
+
+    class Meta:
+        database = database
+
+
+class SampleJunction(Model):
+    sample = ForeignKeyField(Sample)
+    gene_name = TextField()
+    nm_number = CharField()
+    position = IntegerField()
+    query_start = IntegerField()
+    frame = TextField()
+    orf = TextField()
+    inframe_inorf = BooleanField()
+    count = IntegerField()
+    ppm = FloatField()
+
+    class Meta:
+        database = database
+        table_name = 'sample_junction'
+
+
+class ExperimentDatabase(object):
+    """Experiment wide store holding the junctions of every sample database, keyed by sample."""
+
+    def __init__(self, db_name):
+        self.db = database
+        self.db.init(db_name)
+        self.migrator = SqliteMigrator(self.db)
+
+    def create_tables(self):
+        self.db.drop_tables([SampleJunction, Sample])
+        self.db.create_tables([Sample, SampleJunction])
+
+    def create_indexes(self):
+        # covering indexes for gene lookups (`deepn query`) and per-sample scans
+        self.db.execute_sql("CREATE INDEX IF NOT EXISTS sample_junction_gene_covering ON sample_junction "
+                            "(gene_name, sample_id, position, query_start, frame, orf, count, ppm, nm_number)")
+        migrate(self.migrator.add_index('sample_junction', ('nm_number', 'sample_id')),
+                self.migrator.add_index('sample_junction', ('sample_id', 'gene_name', 'position')))
+
+    def add_sample(self, name, path, selected=False):
+        """Copies the junctions of one sample database into the store with a single INSERT ... SELECT."""
+        self.db.execute_sql("ATTACH DATABASE ? AS sample_db", (path,))
+        try:
+            tables = [row[0] for row in self.db.execute_sql("SELECT name FROM sample_db.sqlite_master "
+                                                            "WHERE type = 'table'")]
+            if 'summary' in tables:
+                blast_count = self.db.execute_sql("SELECT blast_count FROM sample_db.summary").fetchone()[0]
+            else:
+                # databases parsed before the summary table existed: recover the query count from the ppm values
+                row = self.db.execute_sql("SELECT count * 1000000.0 / ppm FROM sample_db.junction "
+                                          "WHERE ppm > 0 LIMIT 1").fetchone()
+                blast_count = int(round(row[0])) if row else 0
+            # junctions store the NM number of their transcript, older databases only that of the gene entry
+            junction_columns = [row[1] for row in self.db.execute_sql("PRAGMA sample_db.table_info(junction)")]
+            nm_number = 'j.nm_number' if 'nm_number' in junction_columns else 'g.nm_number'
+            sample = Sample.create(name=name, selected=selected, blast_count=blast_count)
+            self.db.execute_sql("INSERT INTO sample_junction (sample_id, gene_name, nm_number, position, query_start, "
+                                "frame, orf, inframe_inorf, count, ppm) "
+                                "SELECT ?, g.gene_name, %s, j.position, j.query_start, j.frame, j.orf, "
+                                "j.inframe_inorf, j.count, j.ppm "
+                                "FROM sample_db.junction j JOIN sample_db.gene g ON g.id = j.gene_id" % nm_number,
+                                (sample.id,))
+        finally:
+            self.db.execute_sql("DETACH DATABASE sample_db")
+        return sample
+
+    def analyze(self):
+        self.db.execute_sql("ANALYZE")
+
+    def close_db(self):
+        self.db.close()
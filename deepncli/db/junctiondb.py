@@ -26,7 +26,8 @@ class Gene(Model):
 
 
 class Junction(Model):
-    gene = ForeignKeyField(Gene)
+    gene = ForeignKeyField(Gene)  # first gene entry of the gene name, shared by all its transcripts
+    nm_number = CharField()  # transcript the junction read was aligned to
     position = IntegerField()
     query_start = IntegerField()
     frame = TextField()
@@ -55,6 +56,15 @@ class Stats(Model):
         database = database
 
 
+class Summary(Model):
+    blast_count = IntegerField()
+    accepted_count = IntegerField()
+    rejected_count = IntegerField()
+
+    class Meta:
+        database = database
+
+
 class JunctionsDatabase(object):
     def __init__(self, db_name):
         self.db = database
@@ -62,14 +72,26 @@ class JunctionsDatabase(object):
         self.migrator = SqliteMigrator(self.db)
 
     def create_tables(self):
-        self.db.drop_tables([Stats, Junction, Gene])
-        self.db.create_tables([Gene, Junction, Stats])
+        self.db.drop_tables([Summary, Stats, Junction, Gene])
+        self.db.create_tables([Gene, Junction, Stats, Summary])
         self.create_indexes()
 
     def create_indexes(self):
-        migrate(self.migrator.add_index('gene', ('id', 'gene_name', 'nm_number')),
-                self.migrator.add_index('junction', ('id', 'gene_id')),
-                self.migrator.add_index('stats', ('id', 'gene_id')))
+        # gene lookups by name or NM number (used while loading junctions and by `deepn query`)
+        migrate(self.migrator.add_index('gene', ('gene_name', 'nm_number')),
+                self.migrator.add_index('gene', ('nm_number',)))
+
+    def finalize(self):
+        """Builds the covering indexes for gene level queries once all rows are written and runs ANALYZE."""
+        self.db.execute_sql("CREATE INDEX IF NOT EXISTS junction_gene_covering ON junction "
+                            "(gene_id, position, query_start, frame, orf, count, ppm, inframe_inorf, nm_number)")
+        self.db.execute_sql("CREATE INDEX IF NOT EXISTS junction_nm_covering ON junction "
+                            "(nm_number, position, query_start, frame, orf, count, ppm)")
+        self.db.execute_sql("ANALYZE")
+
+    def has_junction_nm_number(self):
+        """False for databases written before junctions stored the NM number of their transcript."""
+        return 'nm_number' in [row[1] for row in self.db.execute_sql("PRAGMA table_info(junction)")]
 
     def close_db(self):
         self.db.close()
@@ -0,0 +1,134 @@
+import os
+import heapq
+import struct
+import tempfile
+
+FRAMES = ('in_frame', 'not_in_frame', 'intron', 'backwards')
+ORFS = ('in_orf', 'upstream', 'downstream')
+
+# Junction keys are packed into 63 bits (so they stay plain ints on 64-bit python):
+# nm id (19) | frame (2) | orf (2) | position (26) | query start (14)
+QUERY_START_BITS = 14
+POSITION_BITS = 26
+ORF_BITS = 2
+FRAME_BITS = 2
+NM_BITS = 19
+
+# Approximate cost of one dictionary entry (slot, key and count objects) on 64-bit CPython
+ENTRY_BYTES = 120
+SPILL_RECORD = struct.Struct('<QQ')
+SPILL_BATCH = 4096
+
+
+class JunctionCounter(object):
+    """Counts junctions keyed by (nm_number, frame, orf, position, query_start).
+
+    NM numbers are interned to small integer ids and the frame/orf labels are stored as enums, so every junction
+    key is a single packed integer. When the number of distinct keys exceeds the memory limit (in MB) the counts
+    are written to disk as a sorted run, and `items` merges all runs back with a sort-and-reduce pass.
+
+    Counters created with the same nm_numbers table give the same keys, so their runs can be merged with `add_runs`
+    without decoding them.
+    """
+
+    def __init__(self, memory_limit=1024, spill_directory=None, nm_numbers=()):
+        self.nm_numbers = []
+        self.nm_ids = {}
+        for nm_number in nm_numbers:
+            self.intern(nm_number)
+        self.counts = {}
+        self.max_entries = max(1, int(memory_limit) * 1024 * 1024 // ENTRY_BYTES)
+        self.spill_directory = spill_directory
+        self.spill_files = []
+
+    def intern(self, nm_number):
+        nm_id = self.nm_ids.get(nm_number)
+        if nm_id is None:
+            nm_id = len(self.nm_numbers)
+            if nm_id >> NM_BITS:
+                raise ValueError("Too many distinct NM numbers to pack (%d)" % nm_id)
+            self.nm_ids[nm_number] = nm_id
+            self.nm_numbers.append(nm_number)
+        return nm_id
+
+    def encode(self, nm_number, frame, orf, position, query_start):
+        if position >> POSITION_BITS or query_start >> QUERY_START_BITS or position < 0 or query_start < 0:
+            raise ValueError("Junction position %d or query start %d out of range" % (position, query_start))
+        key = self.intern(nm_number)
+        key = (key << FRAME_BITS) | FRAMES.index(frame)
+        key = (key << ORF_BITS) | ORFS.index(orf)
+        key = (key << POSITION_BITS) | position
+        return (key << QUERY_START_BITS) | query_start
+
+    def decode(self, key):
+        query_start = key & ((1 << QUERY_START_BITS) - 1)
+        key >>= QUERY_START_BITS
+        position = key & ((1 << POSITION_BITS) - 1)
+        key >>= POSITION_BITS
+        orf = ORFS[key & ((1 << ORF_BITS) - 1)]
+        key >>= ORF_BITS
+        frame = FRAMES[key & ((1 << FRAME_BITS) - 1)]
+        key >>= FRAME_BITS
+        return self.nm_numbers[key], frame, orf, position, query_start
+
+    def add(self, nm_number, frame, orf, position, query_start, count=1):
+        self.add_key(self.encode(nm_number, frame, orf, position, query_start), count)
+
+    def add_key(self, key, count=1):
+        counts = self.counts
+        counts[key] = counts.get(key, 0) + count
+        if len(counts) > self.max_entries:
+            self.spill()
+
+    def merge(self, other):
+        """Adds the counts of another counter (with its own NM number ids) and closes it."""
+        for key, count in other.items():
+            self.add_key(self.encode(*other.decode(key)), count)
+        other.close()
+
+    def add_runs(self, spill_files):
+        """Takes over the sorted runs spilled by another counter with the same NM number table."""
+        self.spill_files.extend(spill_files)
+
+    def spill(self):
+        handle = tempfile.NamedTemporaryFile(prefix='junctions_', suffix='.spill', dir=self.spill_directory,
+                                             delete=False)
+        self.spill_files.append(handle.name)
+        pack = SPILL_RECORD.pack
+        keys = sorted(self.counts)
+        for i in range(0, len(keys), SPILL_BATCH):
+            handle.write(b''.join(pack(key, self.counts[key]) for key in keys[i:i + SPILL_BATCH]))
+        handle.close()
+        self.counts = {}
+
+    def _read_spill(self, path):
+        with open(path, 'rb') as handle:
+            size = SPILL_RECORD.size
+            buf = handle.read(size * SPILL_BATCH)
+            while buf:
+                for offset in range(0, len(buf), size):
+                    yield SPILL_RECORD.unpack_from(buf, offset)
+                buf = handle.read(size * SPILL_BATCH)
+
+    def items(self):
+        """Yields (key, count) pairs in key order, merging the in-memory counts with all spilled runs."""
+        runs = [self._read_spill(path) for path in self.spill_files]
+        runs.append(iter(sorted(self.counts.items())))
+        current_key = None
+        current_count = 0
+        for key, count in heapq.merge(*runs):
+            if key != current_key:
+                if current_key is not None:
+                    yield current_key, current_count
+                current_key = key
+                current_count = 0
+            current_count += count
+        if current_key is not None:
+            yield current_key, current_count
+
+    def close(self):
+        for path in self.spill_files:
+            if os.path.exists(path):
+                os.remove(path)
+        self.spill_files = []
+        self.counts = {}
@@ -0,0 +1,216 @@
+# project imports
+from ..api import make_search_junctions
+from .proteinprocessor import ProteinProcessor
+# Other imports
+import sys
+import click
+from array import array
+from functools import partial
+from collections import OrderedDict
+import warnings
+warnings.filterwarnings("ignore")
+
+
+green_fg = partial(click.style, fg='green')
+yellow_fg = partial(click.style, fg='yellow')
+magenta_fg = partial(click.style, fg='magenta')
+cyan_fg = partial(click.style, fg='cyan')
+red_fg = partial(click.style, fg='red')
+
+junction_length = 50  # length of the junction sequences in junction_sequences
+search_length = 28  # bases at the end of a junction used by make_search_junctions (junc[22:50])
+
+
+class KmerSketch(object):
+    """Count-min sketch (two rows of 2**width_bits counters) of the k-mers in a stream of reads.
+
+    Estimates never undercount. K-mers whose estimate reaches min_count are kept in `candidates`, so the heavy
+    hitters can be read back without storing every distinct k-mer.
+    """
+
+    def __init__(self, k=20, width_bits=20, min_count=16):
+        self.k = k
+        self.mask = (1 << width_bits) - 1
+        self.shift = width_bits
+        self.rows = [array('I', [0]) * (1 << width_bits), array('I', [0]) * (1 << width_bits)]
+        self.min_count = min_count
+        self.candidates = {}
+
+    def add_sequence(self, sequence):
+        k, mask, shift, min_count = self.k, self.mask, self.shift, self.min_count
+        first, second = self.rows
+        candidates = self.candidates
+        for i in range(len(sequence) - k + 1):
+            kmer = sequence[i:i + k]
+            h = hash(kmer)
+            a = h & mask
+            b = (h >> shift) & mask
+            first[a] += 1
+            second[b] += 1
+            estimate = min(first[a], second[b])
+            if estimate >= min_count:
+                candidates[kmer] = estimate
+
+    def estimate(self, kmer):
+        h = hash(kmer)
+        return min(self.rows[0][h & self.mask], self.rows[1][(h >> self.shift) & self.mask])
+
+    def heavy_hitters(self, min_count):
+        return dict((kmer, count) for kmer, count in self.candidates.items() if count >= min_count)
+
+
+def unmapped_reads(filepath, max_reads):
+    """Yields the sequences of the first max_reads unmapped records of a .sam file."""
+    input_filehandle = open(filepath)
+    reads = 0
+    for line in input_filehandle:
+        line_split = line.split()
+        if len(line_split) and line_split[0][0] != "@" and line_split[2] == "*":
+            yield line_split[9]
+            reads += 1
+            if reads >= max_reads:
+                break
+    input_filehandle.close()
+
+
+def known_junction_groups(known_junctions):
+    """Groups the names of known junctions by sequence: {sequence: 'hg38/saccer3', ...}."""
+    groups = OrderedDict()
+    for name in sorted(known_junctions):
+        groups.setdefault(known_junctions[name], []).append(name)
+    return OrderedDict((sequence, "/".join(names)) for sequence, names in groups.items())
+
+
+def count_junction_reads(reads, junction_groups):
+    """Returns the number of reads and {junction sequences: reads containing one of their search sequences}.
+
+    junction_groups maps a name to a list of junction sequences; reads are checked in both orientations.
+    """
+    processor = ProteinProcessor()
+    search_sequences = dict((name, make_search_junctions(junctions)) for name, junctions in junction_groups.items())
+    hits = dict((name, 0) for name in junction_groups)
+    total = 0
+    for read in reads:
+        total += 1
+        rev_read = processor.reverse_complement(read)
+        for name, sequences in search_sequences.items():
+            for j in sequences:
+                if j in read or j in rev_read:
+                    hits[name] += 1
+                    break
+    return total, hits
+
+
+def assemble(heavy_kmers):
+    """Greedily joins overlapping heavy k-mers into contigs, most frequent first: [(contig, mean count), ...]."""
+    remaining = dict(heavy_kmers)
+    contigs = []
+    while remaining:
+        seed = max(remaining, key=lambda kmer: (remaining[kmer], kmer))
+        counts = [remaining.pop(seed)]
+        contig = seed
+        for extend_right in [True, False]:
+            kmer = seed
+            count = counts[0]
+            while True:
+                if extend_right:
+                    options = [kmer[1:] + base for base in "ACGT" if kmer[1:] + base in remaining]
+                else:
+                    options = [base + kmer[:-1] for base in "ACGT" if base + kmer[:-1] in remaining]
+                # stop where the sequence branches into the diverse insert (counts drop below half)
+                options = [option for option in options if remaining[option] * 2 >= count]
+                if not options:
+                    break
+                kmer = max(options, key=lambda option: remaining[option])
+                count = remaining.pop(kmer)
+                counts.append(count)
+                contig = contig + kmer[-1] if extend_right else kmer[0] + contig
+        contigs.append((contig, float(sum(counts)) / len(counts)))
+    return sorted(contigs, key=lambda contig: -contig[1] * len(contig[0]))
+
+
+def junction_from_contig(contig, reads, k=20):
+    """Orients a vector contig so that the insert follows it and returns the proposed 50 bp junction.
+
+    At the vector/insert boundary the reads continue into diverse insert sequence, at the other end the
+    over-represented sequence stops because the reads start there, so the end with the longer flanking
+    sequence in reads is taken as the junction. Contigs shorter than 50 bp are padded with N; only the last
+    28 bases are used for the junction search.
+    """
+    processor = ProteinProcessor()
+    first_kmer, last_kmer = contig[:k], contig[-k:]
+    before = after = 0
+    for read in reads:
+        if last_kmer in read:
+            after += len(read) - read.index(last_kmer) - k
+        if first_kmer in read:
+            before += read.index(first_kmer)
+    if before > after:
+        contig = processor.reverse_complement(contig)
+    return contig[-junction_length:].rjust(junction_length, 'N')
+
+
+def match_known_junction(junction, junction_groups):
+    """Name of the known junction whose search sequences are found in junction (either orientation), or None."""
+    rev_junction = ProteinProcessor().reverse_complement(junction)
+    for sequence, name in junction_groups.items():
+        if any(j in junction or j in rev_junction for j in make_search_junctions([sequence])):
+            return name
+    return None
+
+
+def detect_junction(filepath, known_junctions, max_reads=200000, k=20, min_fraction=0.01):
+    """Finds the over-represented vector sequence in the first max_reads unmapped reads of a .sam file.
+
+    Returns a dict with the reads read, the reads matching every known junction, the contigs of k-mers seen in at
+    least min_fraction of the reads, the proposed junction and the known junction it matches (if any).
+    """
+    groups = known_junction_groups(known_junctions)
+    total, hits = count_junction_reads(unmapped_reads(filepath, max_reads),
+                                       dict((name, [sequence]) for sequence, name in groups.items()))
+    sketch = KmerSketch(k)
+    for read in unmapped_reads(filepath, max_reads):
+        sketch.add_sequence(read)
+    contigs = [c for c in assemble(sketch.heavy_hitters(max(sketch.min_count, int(total * min_fraction))))
+               if len(c[0]) >= search_length]
+    result = {'reads': total, 'hits': hits, 'contigs': contigs, 'junction': None, 'known': None}
+    if len(contigs):
+        result['junction'] = junction_from_contig(contigs[0][0], unmapped_reads(filepath, max_reads), k)
+        result['known'] = match_known_junction(result['junction'], groups)
+    return result
+
+
+def report_detection(filename, result):
+    click.echo(magenta_fg("\n>>> Junction detection in %s (%d unmapped reads):" % (filename, result['reads'])))
+    for name, count in sorted(result['hits'].items(), key=lambda item: -item[1]):
+        click.echo(yellow_fg("    %-24s %8d reads (%.2f%%)" % (name, count,
+                                                             count * 100.0 / result['reads'] if result['reads'] else 0)))
+    for contig, count in result['contigs'][:3]:
+        click.echo(cyan_fg("    over-represented: %s (%d bp, ~%d reads)" % (contig, len(contig), count)))
+    if result['junction'] is None:
+        click.echo(red_fg("    No over-represented vector sequence found."))
+    elif result['known']:
+        click.echo(green_fg("    Detected junction matches %s: %s" % (result['known'], result['junction'])))
+    else:
+        click.echo(green_fg("    Proposed junction (use with --seq): %s" % result['junction']))
+
+
+def check_junction_sequence(filepaths, junction_sequence, known_junctions, max_reads=100000):
+    """Exits before the junction search when junction_sequence is missing from the first reads of a .sam file,
+    or when a different known junction is found in at least 10 times more reads, and reports the detected one."""
+    groups = dict((name, [sequence]) for sequence, name in known_junction_groups(known_junctions).items())
+    groups['selected'] = junction_sequence
+    for filepath in filepaths:
+        total, hits = count_junction_reads(unmapped_reads(filepath, max_reads), groups)
+        if not total:
+            continue
+        best_other = max([count for name, count in hits.items() if name != 'selected'] or [0])
+        if hits['selected'] == 0 or best_other > 10 * hits['selected']:
+            click.echo(red_fg("\n>>> ERROR: The junction sequence is found in %d of the first %d unmapped reads "
+                              "of %s." % (hits['selected'], total, filepath)))
+            report_detection(filepath, detect_junction(filepath, known_junctions, max_reads))
+            click.echo(red_fg(">>> Choose the matching --genome or pass the junction with --seq "
+                              "(or use --skip_detect)."))
+            sys.exit(1)
+        click.echo(cyan_fg(">>> Junction sequence found in %d of the first %d unmapped reads of %s."
+                           % (hits['selected'], total, filepath)))
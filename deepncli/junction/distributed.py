@@ -0,0 +1,106 @@
+# project imports
+from ..utils.io import get_sam_filelist
+from ..utils.workqueue import WorkQueue, write_json_atomic, read_json, default_worker_id
+from .main import process_sample
+# Other imports
+import os
+import sys
+import time
+import click
+import shutil
+from tqdm import tqdm
+from functools import partial
+import warnings
+warnings.filterwarnings("ignore")
+
+
+green_fg = partial(click.style, fg='green')
+yellow_fg = partial(click.style, fg='yellow')
+magenta_fg = partial(click.style, fg='magenta')
+cyan_fg = partial(click.style, fg='cyan')
+red_fg = partial(click.style, fg='red')
+
+queue_folder = 'work_queue'  # Manage name of the distributed work queue folder here
+
+
+def open_queue(directory):
+    settings = read_json(os.path.join(directory, queue_folder, 'settings.json'))
+    return WorkQueue(os.path.join(directory, queue_folder), lease_timeout=settings['lease_timeout'],
+                     heartbeat_interval=max(1, settings['lease_timeout'] // 10)), settings
+
+
+def submit_samples(directory, settings):
+    """Creates a fresh work queue in the work folder with one task per .sam file."""
+    sam_files = get_sam_filelist(directory, settings['input_data_folder'])
+    if not len(sam_files):
+        click.echo(red_fg("\n>>> ERROR: No .sam files found in directory %s." % directory))
+        sys.exit(1)
+    queue_path = os.path.join(directory, queue_folder)
+    if os.path.exists(queue_path):
+        shutil.rmtree(queue_path)
+    queue = WorkQueue(queue_path)
+    queue.create()
+    write_json_atomic(os.path.join(queue_path, 'settings.json'), settings)
+    for f in sam_files:
+        queue.put(os.path.splitext(f)[0], {'filename': f})
+    click.echo(cyan_fg("\n>>> Queued %d samples in %s." % (len(sam_files), queue_path)))
+    click.echo(yellow_fg("    Start workers on any node that mounts the work folder with:"))
+    click.echo(yellow_fg("    deepn worker --dir %s" % os.path.abspath(directory)))
+
+
+def wait_for_samples(directory, poll_interval=10):
+    queue, settings = open_queue(directory)
+    total = len(queue.task_ids())
+    bar = tqdm(total=total, unit=' samples', desc="Queue",
+               bar_format="{desc}: {percentage:3.0f}% | elapsed: {elapsed}, "
+                          "remaining: {remaining} | {rate_fmt}{postfix}")
+    finished = 0
+    while finished < total:
+        time.sleep(poll_interval)
+        now_finished = total - len(queue.pending_ids())
+        bar.update(now_finished - finished)
+        finished = now_finished
+    bar.close()
+
+
+def merge_results(directory):
+    """Collects the per-sample results of all workers into work_queue/summary.txt and returns the failed ids."""
+    queue, settings = open_queue(directory)
+    summary_path = os.path.join(queue.directory, 'summary.txt')
+    summary_handle = open(summary_path, 'w')
+    summary_handle.write("\t".join(['sample', 'status', 'worker', 'elapsed', 'junctions', 'blast_queries',
+                                    'accepted_hits']) + "\n")
+    for task_id in queue.done_ids():
+        result = queue.result(task_id)
+        summary_handle.write("\t".join([task_id, 'done', result['worker'], "%.1f" % result['elapsed']] +
+                                       [str(result['result'][k]) for k in ['junctions', 'blast_queries',
+                                                                           'accepted_hits']]) + "\n")
+    failed = queue.failed_ids()
+    for task_id in failed:
+        result = queue.result(task_id)
+        summary_handle.write("\t".join([task_id, 'failed', result['worker'], "%.1f" % result['elapsed'],
+                                        '', '', '']) + "\n")
+        click.echo(red_fg(">>> ERROR: Sample %s failed on worker %s: %s" % (task_id, result['worker'],
+                                                                          result['error'])))
+    summary_handle.close()
+    click.echo(green_fg("\n>>> Merged results of %d samples into %s" % (len(queue.done_ids()), summary_path)))
+    return failed
+
+
+def run_worker(directory, wait=False, poll_interval=10, budget=None):
+    if not os.path.exists(os.path.join(directory, queue_folder, 'settings.json')):
+        click.echo(red_fg(">>> ERROR: No work queue found in work folder (%s)." % directory))
+        sys.exit(1)
+    queue, settings = open_queue(directory)
+    worker_id = default_worker_id()
+    click.echo(cyan_fg("\n>>> Worker %s processing queue %s" % (worker_id, queue.directory)))
+
+    def handler(task_id, payload):
+        return process_sample(directory, settings, payload['filename'], budget)
+
+    def on_claim(task_id):
+        click.echo(magenta_fg("\n>>> Worker %s claimed sample %s" % (worker_id, task_id)))
+
+    processed = queue.run_worker(handler, worker_id=worker_id, wait=wait, poll_interval=poll_interval,
+                                 on_claim=on_claim)
+    click.echo(green_fg("\n>>> Worker %s finished after processing %d samples." % (worker_id, len(processed))))
@@ -1,19 +1,25 @@
 # project imports
-from ..db.junctiondb import JunctionsDatabase, Gene, Junction, Stats
-from ..utils.io import get_sam_filelist, get_file_list, make_fasta_file, concatenate_dicts, count_lines
+from ..db.junctiondb import JunctionsDatabase, Gene, Junction, Summary
+from ..utils.io import get_sam_filelist, get_file_list, open_output, split_on_headers, read_lines, follow_lines, \
+    progress_lines, WRITE_BUFFER_SIZE
 from ..utils.time import elapsed_time
-from proteinprocessor import ProteinProcessor as PProcessor
+from ..utils.resources import budget_tokens, run_with_cores
+from ..api import make_search_junctions, search_junctions, iter_blast_hits, gene_list_entry, BlastParseCounts
+from .aggregate import JunctionCounter
+from .tiered import first_pass_suffix, misses_query_suffix, misses_output_suffix, single_pass_suffix, report_suffix, \
+    missed_queries, write_queries, merge_blast_outputs, compare_passes, write_tier_report
 # Other imports
 import os
 import sys
 import time
 import click
+import errno
 import subprocess
 from tqdm import tqdm
 from functools import partial
 from sys import platform as _platform
 import joblib.parallel as parallel
-from collections import Counter, defaultdict
+from collections import defaultdict, OrderedDict
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -25,87 +31,72 @@ cyan_fg = partial(click.style, fg='cyan')
 red_fg = partial(click.style, fg='red')
 
 file_read_progress = {}
+gene_list_cache = {}
+INSERT_BATCH = 100  # rows per INSERT statement (9 columns at most, below the SQLite limit of 999 variables)
 
 
-def make_search_junctions(junctions_array):
-    junction_sequences = []
-    for junc in junctions_array:
-        junction_sequences.append(junc[30:50])
-        junction_sequences.append(junc[26:46])
-        junction_sequences.append(junc[22:42])
-    return junction_sequences
+def search_for_junctions(filepath, jseqs, exclusion_sequence, output_filehandle, max_mismatches=0,
+                         fasta_filehandle=None, follow_timeout=None, engine='text'):
+    """Writes the junction hits of a .sam file (or stdin for '-') and returns their number.
 
-
-def junctions_in_read(read, junction_sequences):
-    match_index = -1
-    junction_index = -1
-    for i, j in enumerate(junction_sequences):
-        if j in read:
-            match_index = read.index(j)
-            junction_index = i
-    return junction_index, match_index
-
-
-def search_for_junctions(filepath, jseqs, exclusion_sequence, output_filehandle):
+    With follow_timeout the file is read while it is being written, until it has not grown for that many seconds.
+    """
     hits_count = 0
-    processor = PProcessor()
-
-    def check_matching_criteria(l, indexes, jseqs, read):
-        value = 0
-        if indexes[0] != -1:
-            junction = jseqs[indexes[0]]
-            downstream_rf = read[len(junction) + indexes[1] + (indexes[0] % 3) * 4:]
-            if len(downstream_rf) > 25:
-                if exclusion_sequence not in downstream_rf or exclusion_sequence == '':
-                    value = 1
-                    protein_sequence = processor.translate_orf(downstream_rf)
-                    output_filehandle.write(" ".join(l[:4]) + " " + l[9] + " " + downstream_rf
-                                            + " " + protein_sequence + "\n")
-        return value
-
-    input_filehandle = open(filepath)
-    bar = tqdm(total=count_lines(filepath), unit=' lines',
+    input_filehandle = sys.stdin if filepath == '-' else open(filepath)
+    streaming = filepath == '-' or follow_timeout is not None
+    bar = tqdm(total=None if streaming else os.path.getsize(filepath), unit='B', unit_scale=True,
                desc="Search",
-               bar_format="{desc}: {percentage:3.0f}% | elapsed: {elapsed}, "
+               bar_format="{desc}: {n_fmt} | elapsed: {elapsed} | {rate_fmt}{postfix}" if streaming else
+                          "{desc}: {percentage:3.0f}% | elapsed: {elapsed}, "
                           "remaining: {remaining} | {rate_fmt}{postfix}")
-    for line in input_filehandle:
-        line_split = line.strip().split()
-        if line_split[0][0] != "@" and line_split[2] == "*":
-            sequence_read = line_split[9]
-            rev_sequence_read = processor.reverse_complement(sequence_read)
-            fwd_indexes = junctions_in_read(sequence_read, jseqs)
-            hit = check_matching_criteria(line_split, fwd_indexes, jseqs, sequence_read)
-            if hit == 0:
-                rev_indexes = junctions_in_read(rev_sequence_read, jseqs)
-                hit = check_matching_criteria(line_split, rev_indexes, jseqs, rev_sequence_read)
-            hits_count += hit
-        bar.update(1)
-    input_filehandle.close()
-
-
-def multi_convert(directory, infolder, outfolder):
-    file_list = get_file_list(directory, infolder, ".txt")
-    for f in file_list:
-        make_fasta_file(os.path.join(directory, infolder, f), os.path.join(directory, outfolder, f[:-4] + ".fa"))
-
-
-def jsearch(directory, filename, input_data_folder, junction_folder, junction_sequence, exclusion_sequence):
+    lines = follow_lines(input_filehandle, follow_timeout) if follow_timeout is not None else input_filehandle
+    for hit in search_junctions(progress_lines(lines, bar), jseqs, exclusion_sequence, max_mismatches, engine):
+        output_filehandle.write(hit.junction_line())
+        if fasta_filehandle:
+            fasta_filehandle.write(hit.fasta_record())
+        hits_count += 1
+    bar.close()
+    if input_filehandle is not sys.stdin:
+        input_filehandle.close()
+    return hits_count
+
+
+class FastaTee(object):
+    """Writes the FASTA records of junction hits to several handles (the .junctions.fa file and blastn's stdin)."""
+
+    def __init__(self, *handles):
+        self.handles = handles
+
+    def write(self, data):
+        for handle in self.handles:
+            handle.write(data)
+
+
+def jsearch(directory, filename, input_data_folder, junction_folder, blast_results_folder, junction_sequence,
+            exclusion_sequence, max_mismatches, compression, engine='text'):
     exclusion_sequence = exclusion_sequence.upper() if exclusion_sequence else ""
     click.echo(green_fg('\n>>> Searching junctions in file: %s' % filename))
     start = time.time()
     filepath = os.path.join(directory, input_data_folder, filename)
 
-    output_file_handle = open(os.path.join(directory, junction_folder, filename.replace(".sam", '.junctions.txt')), 'w')
-    search_for_junctions(filepath, junction_sequence, exclusion_sequence,
-                         output_file_handle)
+    junction_filepath = os.path.join(directory, junction_folder, filename.replace(".sam", '.junctions.txt'))
+    output_file_handle = open_output(junction_filepath, compression)
+    fasta_file_handle = open(os.path.join(directory, blast_results_folder, filename.replace(".sam", '.junctions.fa')),
+                             'w', WRITE_BUFFER_SIZE)
+    hits_count = search_for_junctions(filepath, junction_sequence, exclusion_sequence,
+                                      output_file_handle, max_mismatches, fasta_file_handle, engine=engine)
     output_file_handle.close()
+    fasta_file_handle.close()
     finish = time.time()
     hr, min, sec = elapsed_time(start, finish)
+    click.echo(magenta_fg('\n>>> Wrote %d junctions in %s to a FASTA file.' % (hits_count, filename)))
     click.echo(cyan_fg("\nFinished searching junctions in %s in time %d hr, %d min, %d sec" % (filename, hr, min, sec)))
+    return hits_count
 
 
 def junction_search(directory, junction_folder, input_data_folder, blast_results_folder,
-                    junction_sequence, exclusion_sequence, threads):
+                    junction_sequence, exclusion_sequence, threads, max_mismatches=0, compression='none',
+                    budget=None, engine='text'):
     unmap_files = get_sam_filelist(directory, input_data_folder)
     if not len(unmap_files):
         click.echo(red_fg("\n>>> ERROR: No .sam files found in directory %s." % directory))
@@ -114,78 +105,176 @@ def junction_search(directory, junction_folder, input_data_folder, blast_results
     click.echo(cyan_fg("\n>>> The primary, secondary, and tertiary sequences searched are:"))
     for j in junction_seqs:
         click.echo(yellow_fg("    %s" % j))
+    if max_mismatches:
+        click.echo(cyan_fg(">>> Allowing up to %d mismatches in the junction sequences." % max_mismatches))
+    if engine == 'packed':
+        click.echo(cyan_fg(">>> Screening reads in NumPy batches (packed engine)."))
     click.echo(cyan_fg('\n>>> Starting junction search on %s cores.' % threads))
-    parallel.Parallel(n_jobs=threads)(parallel.delayed(jsearch)(directory, f, input_data_folder, junction_folder,
-                                                                junction_seqs, exclusion_sequence) for f in unmap_files)
-    multi_convert(directory, junction_folder, blast_results_folder)
+    parallel.Parallel(n_jobs=threads)(parallel.delayed(run_with_cores)(budget, 'search', jsearch, directory, f,
+                                                                       input_data_folder, junction_folder,
+                                                                       blast_results_folder, junction_seqs,
+                                                                       exclusion_sequence, max_mismatches,
+                                                                       compression, engine) for f in unmap_files)
 
 
-def blast_search(directory, db_name, blast_results_folder):
+def blast_command(db_name, query, output_file, threads, task='blastn'):
     suffix = ''
     if _platform.startswith('win'):
         suffix = '.exe'
     blast_path = os.path.join(os.path.expanduser('~'), ".deepn", "data", "blast")
     db_path = os.path.join(os.path.expanduser('~'), ".deepn", db_name)
+    return [os.path.join(blast_path, 'blastn' + suffix),
+            '-query', query, '-db', db_path,
+            '-task', task, '-dust', 'no', '-num_threads', str(threads),
+            '-outfmt', '7', '-out', output_file, '-evalue', '0.2', '-max_target_seqs', '10']
+
+
+def start_blast(blast_command_list, cores, budget=None, **kwargs):
+    if budget is None:
+        return subprocess.Popen(blast_command_list, shell=False, **kwargs)
+    return budget.popen(blast_command_list, cores, shell=False, **kwargs)
+
+
+def run_blast(blast_command_list, cores, budget, file_name):
+    blast_pipe = start_blast(blast_command_list, cores, budget)
+    blast_pipe.wait()
+    if blast_pipe.returncode != 0:
+        click.echo(red_fg("\n>>> ERROR: BLAST search for file %s failed with exit code %d."
+                          % (file_name, blast_pipe.returncode)))
+        sys.exit(1)
+
+
+def blast_misses(db_name, query, first_output, output_file, cores, budget=None, first_seconds=0.0,
+                 tier_report=False):
+    """Second tier of a tiered BLAST: the queries without an accepted hit in the first pass output are blasted with
+    the sensitive settings and their blocks replace the first pass blocks in output_file.
+
+    With tier_report all queries are also blasted in a single sensitive pass and the accepted hits of both are
+    compared in <sample>.tier_report.tsv.
+    """
+    start = time.time()
+    base = query.replace(".junctions.fa", "")
+    missed = missed_queries(first_output)
+    click.echo(yellow_fg(">>> Blasting %d queries without an accepted first pass hit with blastn" % len(missed)))
+    if len(missed):
+        write_queries(query, base + misses_query_suffix, missed)
+        run_blast(blast_command(db_name, base + misses_query_suffix, base + misses_output_suffix, len(cores)),
+                  cores, budget, base + misses_query_suffix)
+    else:
+        open(base + misses_output_suffix, 'w').close()
+    merge_blast_outputs(first_output, base + misses_output_suffix, output_file)
+    timings = {'first_pass': first_seconds, 'misses': time.time() - start}
+    if tier_report:
+        start = time.time()
+        click.echo(yellow_fg(">>> Blasting all queries in a single sensitive pass for the tier report"))
+        run_blast(blast_command(db_name, query, base + single_pass_suffix, len(cores)), cores, budget, query)
+        timings['single_pass'] = time.time() - start
+        counts, differences = compare_passes(output_file, base + single_pass_suffix)
+        write_tier_report(base + report_suffix, os.path.basename(base), timings, len(missed), counts, differences)
+        os.remove(base + single_pass_suffix)
+    for path in [first_output, base + misses_query_suffix, base + misses_output_suffix]:
+        if os.path.exists(path):
+            os.remove(path)
+    return timings
+
+
+def blast_file(directory, db_name, blast_results_folder, file_name, budget=None, first_pass='none',
+               tier_report=False):
+    """BLASTs the junctions of a sample, in a single sensitive pass or, with first_pass (megablast/dc-megablast),
+    in a fast first pass followed by a sensitive pass over the queries it missed."""
+    if os.path.getsize(os.path.join(directory, blast_results_folder, file_name)) == 0:
+        click.echo(red_fg("\n>>> ERROR: File %s does not have any junctions, "
+                          "please check if they right genome was chosen." % file_name))
+        sys.exit(1)
+    start = time.time()
+    query = os.path.join(directory, blast_results_folder, file_name)
+    output_file = os.path.join(directory, blast_results_folder, file_name.replace(".junctions.fa", '.blast.txt'))
+    with budget_tokens(budget, 'blast', parallel.cpu_count()) as cores:
+        if first_pass == 'none':
+            click.echo(yellow_fg("\n>>> Running BLAST search for file: %s on %d cores" % (file_name, len(cores))))
+            run_blast(blast_command(db_name, query, output_file, len(cores)), cores, budget, file_name)
+        else:
+            click.echo(yellow_fg("\n>>> Running %s first pass for file: %s on %d cores" % (first_pass, file_name,
+                                                                                          len(cores))))
+            first_output = query.replace(".junctions.fa", first_pass_suffix)
+            run_blast(blast_command(db_name, query, first_output, len(cores), first_pass), cores, budget, file_name)
+            blast_misses(db_name, query, first_output, output_file, cores, budget, time.time() - start, tier_report)
+    finish = time.time()
+    hr, min, sec = elapsed_time(start, finish)
+    click.echo(cyan_fg("\nFinished blasting file %s in time %d hr, %d min, %d sec" % (file_name, hr, min, sec)))
+
+
+def blast_search(directory, db_name, blast_results_folder, budget=None, first_pass='none', tier_report=False):
     click.echo(green_fg("\n>>> Selected Blast DB: %s" % db_name))
     file_list = get_file_list(directory, blast_results_folder, ".fa")
     for file_name in file_list:
-        if not os.path.getsize(os.path.join(directory, blast_results_folder, file_name)) == 0:
-            start = time.time()
-            output_file = os.path.join(directory, blast_results_folder, file_name.replace(".junctions.fa", '.blast.txt'))
-            click.echo(yellow_fg("\n>>> Running BLAST search for file: " + file_name))
-            blast_command_list = [os.path.join(blast_path, 'blastn' + suffix),
-                                  '-query', os.path.join(directory, blast_results_folder, file_name), '-db', db_path,
-                                  '-task', 'blastn', '-dust', 'no', '-num_threads', str(parallel.cpu_count()),
-                                  '-outfmt', '7', '-out', output_file, '-evalue', '0.2', '-max_target_seqs', '10']
-            blast_pipe = subprocess.Popen(blast_command_list, shell=False)
-            blast_pipe.wait()
-            finish = time.time()
-            hr, min, sec = elapsed_time(start, finish)
-            click.echo(cyan_fg("\nFinished blasting file %s in time %d hr, %d min, %d sec" % (file_name, hr, min, sec)))
-        else:
-            click.echo(red_fg("\n>>> ERROR: File %s does not have any junctions, "
-                              "please check if they right genome was chosen." % file_name))
-            sys.exit(1)
+        blast_file(directory, db_name, blast_results_folder, file_name, budget, first_pass, tier_report)
+
+
+def load_gene_list(gene_list_path):
+    """Reads a gene list once per process and returns the {nm_number: gene_list_entry} dictionary and the distinct
+    rows of the gene table. Later calls (other chunks and samples, or jobs of `deepn serve`) reuse the cache."""
+    key = (gene_list_path, os.path.getmtime(gene_list_path))
+    if key not in gene_list_cache:
+        nm_gene_dictionary = {}
+        gene_rows = OrderedDict()
+        with open(gene_list_path, "r") as fh:
+            for line in fh:
+                split = line.split()
+                nm_gene_dictionary[split[0]] = gene_list_entry(split)
+                gene_rows[(split[1], int(split[6]) + 1, int(split[7]), split[9].upper(), split[8], split[2],
+                           split[0])] = None
+        gene_list_cache[key] = (nm_gene_dictionary, list(gene_rows))
+    return gene_list_cache[key]
 
 
 def create_gene_list(gene_list_path):
-    fh = open(gene_list_path, "r")
-    nm_gene_dictionary = defaultdict()
-    for line in fh:
-        split = line.split()
-        nm_gene_dictionary[split[0]] = [split[1], int(split[6]) + 1, int(split[7]), split[8]]
-        Gene.get_or_create(gene_name=split[1], orf_start=int(split[6]) + 1, orf_stop=int(split[7]),
-                           mrna=split[9].upper(), intron=split[8], chromosome=split[2], nm_number=split[0])
+    nm_gene_dictionary, gene_rows = load_gene_list(gene_list_path)
+    fields = [Gene.gene_name, Gene.orf_start, Gene.orf_stop, Gene.mrna, Gene.intron, Gene.chromosome, Gene.nm_number]
+    with Gene._meta.database.atomic():
+        for i in range(0, len(gene_rows), INSERT_BATCH):
+            Gene.insert_many(gene_rows[i:i + INSERT_BATCH], fields=fields).execute()
     return nm_gene_dictionary
 
 
-def generate_stats(blast_count):
-    gene_query = Gene.select()
-    for gene in tqdm(gene_query, unit=" genes", desc="Stats",
-                     bar_format="{desc}: {percentage:3.0f}% | elapsed: {elapsed}, "
-                                "remaining: {remaining} | {rate_fmt}{postfix}"):
-        junc_query = Junction.select().where(Junction.gene == gene)
-        frames = []
-        orfs = []
-        inframe_inorfs = []
-        if len(junc_query) >= 1:
-            for j in junc_query.dicts():
-                frames.append(j['frame'])
-                orfs.append(j['orf'])
-                if j['inframe_inorf']:
-                    inframe_inorfs.append('inframe_inorf')
-            insert_dictionary = concatenate_dicts([Counter(frames), Counter(orfs), Counter(inframe_inorfs)])
-            insert_dictionary['gene'] = gene
-            insert_dictionary['total'] = len(junc_query)
-            Stats.insert(**insert_dictionary).execute()
-            for j in junc_query:
-                j.ppm = j.count * 1000000.0 / blast_count
-                j.save()
-
-
-def _parse_blast_results(directory, blast_results_folder, blasttxt, blast_results_query_folder, gene_list_file):
-    start = time.time()
-    click.echo(magenta_fg("\n>>> Reading blast output for file %s" % blasttxt))
+stats_query = ("INSERT INTO stats (gene_id, backwards, downstream, inframe_inorf, in_frame, in_orf, intron, "
+               "not_in_frame, total, upstream) "
+               "SELECT gene_id, SUM(frame = 'backwards'), SUM(orf = 'downstream'), SUM(inframe_inorf), "
+               "SUM(frame = 'in_frame'), SUM(orf = 'in_orf'), SUM(frame = 'intron'), SUM(frame = 'not_in_frame'), "
+               "COUNT(*), SUM(orf = 'upstream') FROM junction GROUP BY gene_id ORDER BY gene_id")
+
+
+def generate_stats(db):
+    db.execute_sql(stats_query)
+
+
+def parse_blast_chunk(blast_filepath, start, end, gene_list_path, memory_limit, spill_directory):
+    """Parses the BLAST queries between the byte offsets start and end, which must fall on `# BLASTN` headers.
+
+    The junction counts are spilled to sorted runs in spill_directory, so only the run paths and the
+    (queries, accepted, rejected) counts of the chunk are returned to the coordinating process. NM numbers are
+    interned in gene list order, so the runs of all chunks share their keys.
+    """
+    nm_gene_dictionary = load_gene_list(gene_list_path)[0]
+    counts = BlastParseCounts()
+    parsed_results = JunctionCounter(memory_limit, spill_directory, sorted(nm_gene_dictionary))
+    lines = tqdm(read_lines(blast_filepath, start, end), unit=' lines',
+                 desc="Parse",
+                 bar_format="{desc}: {n_fmt} | elapsed: {elapsed} | {rate_fmt}{postfix}")
+    for hit in iter_blast_hits(lines, nm_gene_dictionary, counts):
+        parsed_results.add(hit.nm_number, hit.frame, hit.orf, hit.position, hit.query_start)
+    if len(parsed_results.counts):
+        parsed_results.spill()
+    return parsed_results.spill_files, (counts.queries, counts.accepted, counts.rejected)
+
+
+def blast_file_chunks(directory, blast_results_folder, blasttxt, chunks):
+    return split_on_headers(os.path.join(directory, blast_results_folder, blasttxt), "# BLASTN", chunks)
+
+
+def write_junctions(directory, blasttxt, blast_results_query_folder, gene_list_file, chunk_results, start=None):
+    """Merges the spilled runs of the parsed chunks of one BLAST file and writes its junction database."""
+    start = start or time.time()
     blast_parsed_results_filepath = os.path.join(directory, blast_results_query_folder,
                                                  blasttxt.replace(".blast.txt", ".db"))
     gene_list_path = os.path.join(os.path.expanduser('~'), ".deepn", gene_list_file)
@@ -194,88 +283,165 @@ def _parse_blast_results(directory, blast_results_folder, blasttxt, blast_result
     jdb.create_tables()
     # Populate gene table
     nm_gene_dictionary = create_gene_list(gene_list_path)
-    blast_results_handle = open(os.path.join(directory, blast_results_folder, blasttxt), 'r')
-    previous_bitscore = 0
-    blast_count = 0
-    rejected_count = 0
-    accepted_count = 0
-    collect_results = True
-    click.echo(yellow_fg("\n>>> Consolidating blast hits for file %s ..." % blasttxt))
-    parsed_results = defaultdict(int)
-    bar = tqdm(total=count_lines(os.path.join(directory, blast_results_folder, blasttxt)), unit=' lines',
-               desc="Parse",
-               bar_format="{desc}: {percentage:3.0f}% | elapsed: {elapsed}, "
-                          "remaining: {remaining} | {rate_fmt}{postfix}")
-    for line in blast_results_handle:
-        line.strip()
-        split = line.split()
-        if "BLASTN" in line:
-            previous_bitscore = 0
-            collect_results = True
-            blast_count += 1
-
-        elif "hits" in line and int(split[1]) > 100:
-            collect_results = False
-
-        elif split[0] != '#' and collect_results and float(split[2]) > 98 and float(split[11]) > 50.0 and float(split[11]) > previous_bitscore:
-            accepted_count += 1
-            previous_bitscore = float(split[11]) * 0.98
-            nm_number = split[1]
-            gene = nm_gene_dictionary[nm_number][0]
-            position = int(split[8])
-            query_start = int(split[6])
-            fudge_factor = query_start - 1
-            _frame = position - nm_gene_dictionary[nm_number][1] - fudge_factor
-            # Frame Calculation
-            frame = "not_in_frame"
-            if _frame % 3 == 0 or _frame == 0:
-                frame = "in_frame"
-            if nm_gene_dictionary[nm_number][3] == "INTRON":
-                frame = "intron"
-            if int(split[9]) - position < 0:
-                frame = "backwards"
-            # Orf calculation
-            orf = "in_orf"
-            if position < nm_gene_dictionary[nm_number][1]:
-                orf = "upstream"
-            if position > nm_gene_dictionary[nm_number][2]:
-                orf = "downstream"
-            # Frame Orf calculation
-            inframe_inorf = False
-            if frame == 'in_frame' and orf == 'in_orf':
-                inframe_inorf = True
-            parsed_results["|".join([gene, nm_number, frame, orf, str(int(inframe_inorf)), str(position),
-                                     str(query_start)])] += 1
-        else:
-            rejected_count += 1
-        bar.update(1)
+    # the runs are read back in key order with a heap merge, the counts are never all in memory
+    parsed_results = JunctionCounter(nm_numbers=sorted(nm_gene_dictionary))
+    for spill_files, chunk_counts in chunk_results:
+        parsed_results.add_runs(spill_files)
+    blast_count, accepted_count, rejected_count = [sum(c[1][i] for c in chunk_results) for i in range(3)]
     click.echo(red_fg("\n>>> Accepted %d and rejected %d blast hits for file %s ..." % (accepted_count,
                                                                                       rejected_count, blasttxt)))
+    Summary.insert(blast_count=blast_count, accepted_count=accepted_count, rejected_count=rejected_count).execute()
     click.echo(magenta_fg("\n>>> Inserting junctions into "
                           "database %s ..." % os.path.basename(blast_parsed_results_filepath)))
-    for key in tqdm(parsed_results.keys(), unit=" junctions",
-                    desc="Insert",
-                    bar_format="{desc}: {percentage:3.0f}% | elapsed: {elapsed}, "
-                               "remaining: {remaining} | {rate_fmt}{postfix}"):
-        gene_name, nm_number, frame, orf, inframe_inorf, position, query_start = key.split("|")
-        count = parsed_results[key]
-        gene = Gene.select().where(Gene.gene_name == gene_name)
-        Junction.insert(gene=gene, position=position, query_start=query_start,
-                        frame=frame, orf=orf, ppm=0.0, inframe_inorf=inframe_inorf, count=count).execute()
+    # junctions are stored under the first gene entry of their gene name
+    gene_ids = {}
+    for gene_id, gene_name in Gene.select(Gene.id, Gene.gene_name).order_by(Gene.id).tuples():
+        gene_ids.setdefault(gene_name, gene_id)
+    fields = [Junction.gene, Junction.nm_number, Junction.position, Junction.query_start, Junction.frame,
+              Junction.orf, Junction.ppm, Junction.inframe_inorf, Junction.count]
+    rows = []
+    with jdb.db.atomic():
+        for key, count in tqdm(parsed_results.items(), unit=" junctions",
+                               desc="Insert",
+                               bar_format="{desc}: {n_fmt} | elapsed: {elapsed} | {rate_fmt}{postfix}"):
+            nm_number, frame, orf, position, query_start = parsed_results.decode(key)
+            rows.append((gene_ids[nm_gene_dictionary[nm_number][0]], nm_number, position, query_start, frame, orf,
+                         count * 1000000.0 / blast_count, frame == 'in_frame' and orf == 'in_orf', count))
+            if len(rows) == INSERT_BATCH:
+                Junction.insert_many(rows, fields=fields).execute()
+                rows = []
+        if len(rows):
+            Junction.insert_many(rows, fields=fields).execute()
+    parsed_results.close()
 
     click.echo(green_fg("\n>>> Generating gene stats for database %s ..." % os.path.basename(blast_parsed_results_filepath)))
-    generate_stats(blast_count)
+    generate_stats(jdb.db)
+    jdb.finalize()
     finish = time.time()
     hr, min, sec = elapsed_time(start, finish)
     click.echo(cyan_fg("\nFinished parsing blast file %s in time %d hr, %d min, %d sec" % (blasttxt, hr, min, sec)))
     jdb.close_db()
+    return blast_count, accepted_count
 
 
-def parse_blast_results(directory, blast_results_folder, blast_results_query_folder, gene_list_file, threads):
-    blast_results_list = get_file_list(directory, blast_results_folder, ".txt")
-    click.echo(cyan_fg('>>> Parsing blast results on %s cores.' % threads))
-    parallel.Parallel(n_jobs=threads)(parallel.delayed(_parse_blast_results)(directory,
-                                                                             blast_results_folder, f,
-                                                                             blast_results_query_folder,
-                                                                             gene_list_file) for f in blast_results_list)
+def _parse_blast_results(directory, blast_results_folder, blasttxt, blast_results_query_folder, gene_list_file,
+                         memory_limit):
+    start = time.time()
+    click.echo(magenta_fg("\n>>> Reading blast output for file %s" % blasttxt))
+    click.echo(yellow_fg("\n>>> Consolidating blast hits for file %s ..." % blasttxt))
+    gene_list_path = os.path.join(os.path.expanduser('~'), ".deepn", gene_list_file)
+    chunk_result = parse_blast_chunk(os.path.join(directory, blast_results_folder, blasttxt), 0,
+                                     os.path.getsize(os.path.join(directory, blast_results_folder, blasttxt)),
+                                     gene_list_path, memory_limit, os.path.join(directory, blast_results_query_folder))
+    return write_junctions(directory, blasttxt, blast_results_query_folder, gene_list_file, [chunk_result], start)
+
 
+def parse_blast_results(directory, blast_results_folder, blast_results_query_folder, gene_list_file, threads,
+                        memory_limit=1024, budget=None):
+    """Parses every BLAST file in chunks split on query headers, so that a single large file uses all threads,
+    then merges the chunks of each file and writes its database."""
+    start = time.time()
+    blast_results_list = get_file_list(directory, blast_results_folder, ".txt")
+    gene_list_path = os.path.join(os.path.expanduser('~'), ".deepn", gene_list_file)
+    chunks = [(f, chunk) for f in blast_results_list
+              for chunk in blast_file_chunks(directory, blast_results_folder, f, threads)]
+    click.echo(cyan_fg('>>> Parsing %d blast results in %d chunks on %s cores.' % (len(blast_results_list),
+                                                                                 len(chunks), threads)))
+    chunk_results = parallel.Parallel(n_jobs=threads)(parallel.delayed(run_with_cores)(
+        budget, 'parse', parse_blast_chunk, os.path.join(directory, blast_results_folder, f), chunk[0], chunk[1],
+        gene_list_path, memory_limit, os.path.join(directory, blast_results_query_folder)) for f, chunk in chunks)
+    file_results = defaultdict(list)
+    for (f, chunk), chunk_result in zip(chunks, chunk_results):
+        file_results[f].append(chunk_result)
+    parallel.Parallel(n_jobs=threads)(parallel.delayed(run_with_cores)(budget, 'parse', write_junctions,
+                                                                       directory, f, blast_results_query_folder,
+                                                                       gene_list_file, file_results[f], start)
+                                      for f in blast_results_list)
+
+
+def process_sample(directory, settings, filename, budget=None, report=None):
+    """Runs junction search, BLAST and parsing for a single .sam file with the settings of a junction_make run.
+
+    report, if given, is called with the name of every stage as it starts (used by `deepn serve` for job progress).
+    """
+    report = report or (lambda stage: None)
+    junction_seqs = make_search_junctions(settings['junction_sequence'])
+    report('search')
+    hits_count = run_with_cores(budget, 'search', jsearch, directory, filename, settings['input_data_folder'],
+                                settings['junction_folder'], settings['blast_results_folder'], junction_seqs,
+                                settings['exclusion_sequence'], settings['max_mismatches'], settings['compression'],
+                                settings['engine'])
+    report('blast')
+    blast_file(directory, settings['blast_db'], settings['blast_results_folder'],
+               filename.replace(".sam", '.junctions.fa'), budget, settings['first_pass'], settings['tier_report'])
+    report('parse')
+    blast_count, accepted_count = run_with_cores(budget, 'parse', _parse_blast_results, directory,
+                                                 settings['blast_results_folder'],
+                                                 filename.replace(".sam", '.blast.txt'),
+                                                 settings['blast_results_query_folder'], settings['gene_list_file'],
+                                                 settings['parse_memory'])
+    return {'junctions': hits_count, 'blast_queries': blast_count, 'accepted_hits': accepted_count}
+
+
+def stream_sample(directory, settings, name, source='-', budget=None, follow_timeout=None):
+    """Runs junction search, BLAST and parsing for one sample whose SAM records are streamed from stdin ('-') or
+    from a .sam file that is still being written.
+
+    Junction hits are piped to a running blastn as they are found, so BLAST overlaps the search (and the alignment
+    producing the records), and the SAM records are never stored.
+    """
+    junction_seqs = make_search_junctions(settings['junction_sequence'])
+    exclusion_sequence = settings['exclusion_sequence'].upper() if settings['exclusion_sequence'] else ""
+    click.echo(green_fg('\n>>> Streaming junction search for sample %s from %s' %
+                        (name, 'stdin' if source == '-' else source)))
+    start = time.time()
+    output_file_handle = open_output(os.path.join(directory, settings['junction_folder'], name + '.junctions.txt'),
+                                     settings['compression'])
+    fasta_file_handle = open(os.path.join(directory, settings['blast_results_folder'], name + '.junctions.fa'),
+                             'w', WRITE_BUFFER_SIZE)
+    blast_output = os.path.join(directory, settings['blast_results_folder'], name + '.blast.txt')
+    tiered = settings['first_pass'] != 'none'
+    # in a tiered BLAST the first pass is piped and the missed queries are blasted once the search is done
+    pipe_output = blast_output.replace('.blast.txt', first_pass_suffix) if tiered else blast_output
+    with budget_tokens(budget, 'stream', parallel.cpu_count()) as cores:
+        # the search runs in this process on the first core and blastn on the others (or shares a single core)
+        blast_cores = cores[1:] or cores
+        click.echo(yellow_fg(">>> Piping junctions to BLAST on %d cores" % len(blast_cores)))
+        blast_pipe = start_blast(blast_command(settings['blast_db'], '-', pipe_output, len(blast_cores),
+                                               settings['first_pass'] if tiered else 'blastn'),
+                                 blast_cores, budget,
+                                 stdin=subprocess.PIPE, bufsize=WRITE_BUFFER_SIZE, universal_newlines=True)
+        try:
+            hits_count = search_for_junctions(source, junction_seqs, exclusion_sequence, output_file_handle,
+                                              settings['max_mismatches'], FastaTee(fasta_file_handle, blast_pipe.stdin),
+                                              follow_timeout, settings['engine'])
+            blast_pipe.stdin.close()
+        except IOError as e:
+            # blastn exited early, its exit code is reported below
+            if e.errno != errno.EPIPE:
+                raise
+            hits_count = 0
+        output_file_handle.close()
+        fasta_file_handle.close()
+        blast_pipe.wait()
+    if blast_pipe.returncode != 0:
+        click.echo(red_fg("\n>>> ERROR: BLAST search for sample %s failed with exit code %d."
+                          % (name, blast_pipe.returncode)))
+        sys.exit(1)
+    if hits_count == 0:
+        click.echo(red_fg("\n>>> ERROR: Sample %s does not have any junctions, "
+                          "please check if they right genome was chosen." % name))
+        sys.exit(1)
+    if tiered:
+        with budget_tokens(budget, 'blast', parallel.cpu_count()) as cores:
+            blast_misses(settings['blast_db'], os.path.join(directory, settings['blast_results_folder'],
+                                                            name + '.junctions.fa'),
+                         pipe_output, blast_output, cores, budget, time.time() - start, settings['tier_report'])
+    hr, min, sec = elapsed_time(start, time.time())
+    click.echo(cyan_fg("\nFinished searching and blasting %d junctions of sample %s in time %d hr, %d min, %d sec"
+                       % (hits_count, name, hr, min, sec)))
+    blast_count, accepted_count = run_with_cores(budget, 'parse', _parse_blast_results, directory,
+                                                 settings['blast_results_folder'], name + '.blast.txt',
+                                                 settings['blast_results_query_folder'], settings['gene_list_file'],
+                                                 settings['parse_memory'])
+    return {'junctions': hits_count, 'blast_queries': blast_count, 'accepted_hits': accepted_count}
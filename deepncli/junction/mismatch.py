@@ -0,0 +1,80 @@
+from collections import defaultdict
+
+# with 3 or more mismatches the screening pieces of the 20-mer search sequences shrink to 5 bp, nearly every read
+# passes the screen and the search gets about 12x slower than an exact search (2x-4x up to 2 mismatches)
+MAX_MISMATCHES = 2
+
+
+class MismatchMatcher(object):
+    """Finds junction sequences in reads allowing up to `max_mismatches` substitutions.
+
+    All junction sequences are laid side by side in one bit vector and every read is scanned once with a
+    shift-and automaton per allowed mismatch count. Reads are screened first with exact lookups of
+    `max_mismatches + 1` pieces of each junction sequence (any approximate occurrence contains at least one
+    of them unchanged), so most reads never reach the bit-parallel scan.
+    """
+
+    def __init__(self, junction_sequences, max_mismatches):
+        if not 0 <= max_mismatches <= MAX_MISMATCHES:
+            raise ValueError("max_mismatches should be between 0 and %d, not %d" % (MAX_MISMATCHES, max_mismatches))
+        self.junction_sequences = junction_sequences
+        self.max_mismatches = max_mismatches
+        self.masks = defaultdict(int)
+        self.starts = 0
+        self.finals = 0
+        self.final_bits = {}
+        self.pieces = set()
+        offset = 0
+        for i, junction in enumerate(junction_sequences):
+            for k, base in enumerate(junction):
+                self.masks[base] |= 1 << (offset + k)
+            self.starts |= 1 << offset
+            self.finals |= 1 << (offset + len(junction) - 1)
+            self.final_bits[offset + len(junction) - 1] = i
+            offset += len(junction)
+            piece_size = len(junction) // (max_mismatches + 1)
+            for p in range(max_mismatches + 1):
+                end = len(junction) if p == max_mismatches else (p + 1) * piece_size
+                self.pieces.add(junction[p * piece_size:end])
+        self.masks = dict(self.masks)
+
+    def screen(self, read):
+        for piece in self.pieces:
+            if piece in read:
+                return True
+        return False
+
+    def search(self, read):
+        """Returns (junction_index, match_index, mismatches) of the best approximate match or (-1, -1, -1).
+
+        The match with the fewest mismatches wins; ties are resolved like `junctions_in_read`, i.e. the last
+        junction sequence in the list at its first position in the read.
+        """
+        best = (-1, -1, -1)
+        if not self.screen(read):
+            return best
+        masks = self.masks
+        starts = self.starts
+        finals = self.finals
+        states = [0] * (self.max_mismatches + 1)
+        best_key = None
+        for position, base in enumerate(read):
+            mask = masks.get(base, 0)
+            previous = states[0]
+            states[0] = ((previous << 1) | starts) & mask
+            for k in range(1, len(states)):
+                current = states[k]
+                states[k] = (((current << 1) | starts) & mask) | ((previous << 1) | starts)
+                previous = current
+            for k, state in enumerate(states):
+                ends = state & finals
+                if ends:
+                    for bit, junction_index in self.final_bits.items():
+                        if ends >> bit & 1:
+                            key = (k, -junction_index)
+                            if best_key is None or key < best_key:
+                                best_key = key
+                                match_index = position - len(self.junction_sequences[junction_index]) + 1
+                                best = (junction_index, match_index, k)
+                    break
+        return best
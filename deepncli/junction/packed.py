@@ -0,0 +1,146 @@
+"""Batch screening of SAM reads for junction seeds with NumPy (the `packed` search engine).
+
+Reads are converted a batch at a time to 2-bit base codes (A=0, C=1, G=2, T=3) with a mask for N and other
+characters. The 2-bit codes of every k-mer and of its reverse complement are then computed for the whole batch
+with vectorized shifts and compared with the codes of the junction seeds. Only reads containing a seed in either
+orientation are passed on to the exact per-read search, so the results are the same as with the text engine.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BATCH_SIZE = 8192
+BASES = 'ACGT'
+MASKED = 4
+
+
+def packed_available():
+    return np is not None
+
+
+def seed_sequences(search_sequences, max_mismatches=0):
+    """The exact seeds that a read containing one of search_sequences with up to max_mismatches must contain.
+
+    With mismatches every search sequence is cut into max_mismatches + 1 pieces, one of which has no mismatch.
+    """
+    seeds = set()
+    for sequence in search_sequences:
+        length = len(sequence) // (max_mismatches + 1)
+        for i in range(max_mismatches + 1):
+            seeds.add(sequence[i * length:(i + 1) * length])
+    return sorted(seeds)
+
+
+class PackedScreen(object):
+    """Finds the reads of a batch that contain one of the seeds of search_sequences in either orientation."""
+
+    def __init__(self, search_sequences, max_mismatches=0):
+        if not packed_available():
+            raise ImportError("the packed search engine requires the numpy package")
+        self.table = np.full(256, MASKED, dtype=np.uint8)
+        for code, base in enumerate(BASES):
+            self.table[ord(base)] = code
+        seeds = seed_sequences(search_sequences, max_mismatches)
+        self.k = min(len(seed) for seed in seeds)
+        # seeds that are not plain ACGT (or longer than 32 bases) can not be coded, every read is then a candidate
+        self.enabled = 0 < self.k <= 32 and all(len(seed) == self.k and set(seed) <= set(BASES) for seed in seeds)
+        if self.enabled:
+            self.seeds = np.array(sorted(set(self.code(seed) for seed in seeds)), dtype=np.uint64)
+
+    def code(self, seed):
+        value = 0
+        for base in seed:
+            value = (value << 2) | BASES.index(base)
+        return value
+
+    def encode(self, sequences):
+        """2-bit codes of a batch of sequences as an (n, longest) uint8 array, MASKED for N and padding."""
+        lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+        width = max(int(lengths.max()), self.k)
+        if width != lengths.min():
+            # pad shorter reads with N, which is masked like any other base that is not ACGT
+            sequences = [sequence.ljust(width, 'N') for sequence in sequences]
+        joined = np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8)
+        return self.table[joined].reshape(len(sequences), width)
+
+    def screen(self, sequences):
+        """Boolean array marking the sequences that contain a seed or the reverse complement of a seed."""
+        if not self.enabled or not len(sequences):
+            return np.ones(len(sequences), dtype=bool)
+        codes = self.encode(sequences)
+        k = self.k
+        positions = codes.shape[1] - k + 1
+        forward, reverse = kmer_codes(codes, k)
+        # k-mers overlapping an N or the padding of shorter reads
+        masked = np.zeros((len(sequences), codes.shape[1] + 1), dtype=np.int32)
+        np.cumsum(codes == MASKED, axis=1, out=masked[:, 1:])
+        valid = (masked[:, k:] - masked[:, :positions]) == 0
+        hits = (self.contains(forward) | self.contains(reverse)) & valid
+        return hits.any(axis=1)
+
+    def contains(self, kmers):
+        if len(self.seeds) <= 16:
+            found = kmers == self.seeds[0]
+            for seed in self.seeds[1:]:
+                found |= kmers == seed
+            return found
+        # binary search in the sorted seed codes, much cheaper than np.in1d
+        index = np.searchsorted(self.seeds, kmers)
+        return self.seeds[np.minimum(index, len(self.seeds) - 1)] == kmers
+
+
+def kmer_codes(codes, k):
+    """2-bit codes of every k-mer of each row of codes and of the reverse complements of those k-mers.
+
+    Codes of windows of 1, 2, 4, ... bases are built by doubling and combined along the binary digits of k, so a
+    batch takes O(log k) vectorized passes instead of k.
+    """
+    # windows of up to 16 bases fit in 32 bits, which halves the memory traffic of the doubling steps
+    window_forward = (codes & 3).astype(np.uint32)
+    window_reverse = np.uint32(3) - window_forward
+    window = 1
+    forward = reverse = None
+    length = 0
+    while True:
+        if k & window:
+            if forward is None:
+                forward, reverse = window_forward.astype(np.uint64), window_reverse.astype(np.uint64)
+            else:
+                columns = forward.shape[1] - window
+                forward = (forward[:, :columns] << np.uint64(2 * window)) | \
+                    window_forward[:, length:length + columns].astype(np.uint64)
+                reverse = reverse[:, :columns] | \
+                    (window_reverse[:, length:length + columns].astype(np.uint64) << np.uint64(2 * length))
+            length += window
+        if window * 2 > k:
+            break
+        if window == 16:
+            window_forward, window_reverse = window_forward.astype(np.uint64), window_reverse.astype(np.uint64)
+        shift = window_forward.dtype.type(2 * window)
+        columns = window_forward.shape[1] - window
+        window_forward = (window_forward[:, :columns] << shift) | window_forward[:, window:]
+        window_reverse = window_reverse[:, :columns] | (window_reverse[:, window:] << shift)
+        window *= 2
+    positions = codes.shape[1] - k + 1
+    return forward[:, :positions], reverse[:, :positions]
+
+
+def screen_lines(lines, search_sequences, max_mismatches=0, batch_size=BATCH_SIZE):
+    """Yields the unmapped SAM lines that may contain a junction, screening them in batches with `PackedScreen`."""
+    screen = PackedScreen(search_sequences, max_mismatches)
+    batch = []
+    sequences = []
+    for line in lines:
+        fields = line.split('\t', 10)
+        if len(fields) > 9 and fields[0][:1] != "@" and fields[2] == "*":
+            batch.append(line)
+            sequences.append(fields[9])
+            if len(batch) == batch_size:
+                for i in np.flatnonzero(screen.screen(sequences)):
+                    yield batch[i]
+                batch = []
+                sequences = []
+    if len(batch):
+        for i in np.flatnonzero(screen.screen(sequences)):
+            yield batch[i]
@@ -0,0 +1,150 @@
+# project imports
+from ..db.junctiondb import JunctionsDatabase
+from ..utils.io import get_sam_filelist, get_file_list
+from ..utils.workqueue import write_json_atomic, read_json
+# Other imports
+import os
+import sys
+import math
+import click
+from functools import partial
+import warnings
+warnings.filterwarnings("ignore")
+
+
+green_fg = partial(click.style, fg='green')
+yellow_fg = partial(click.style, fg='yellow')
+magenta_fg = partial(click.style, fg='magenta')
+cyan_fg = partial(click.style, fg='cyan')
+red_fg = partial(click.style, fg='red')
+
+preview_prefix = 'preview_'  # Manage prefix of the preview output folders here
+sample_windows = 256  # number of evenly spaced windows each .sam file is sampled from
+
+gene_counts_query = ("SELECT g.gene_name, SUM(j.count) FROM junction j JOIN gene g ON g.id = j.gene_id "
+                     "GROUP BY g.gene_name ORDER BY SUM(j.count) DESC, g.gene_name")
+
+
+def preview_folder(folder):
+    return preview_prefix + folder
+
+
+def sample_sam_file(filepath, output_path, fraction=None, max_reads=None, windows=sample_windows):
+    """Copies a stride sample of the records of a .sam file to output_path without reading the whole file.
+
+    The file is split into `windows` equal byte ranges; in each one the reader seeks to the start and copies
+    consecutive records until the window's share of fraction (of the bytes) or max_reads (of the records) is
+    reached. Reads a short window could not supply are spread over the following windows. Returns the sampled reads, the sampled fraction of the record bytes and the estimated reads in the file.
+    """
+    handle = open(filepath, 'rb')
+    # the header is not sampled
+    line = handle.readline()
+    while line.startswith(b'@'):
+        line = handle.readline()
+    data_start = handle.tell() - len(line)
+    data_size = os.path.getsize(filepath) - data_start
+    if max_reads:
+        windows = max(1, min(windows, max_reads))
+    else:
+        bytes_per_window = fraction * data_size / windows
+    stride = float(data_size) / windows
+    output_handle = open(output_path, 'wb')
+    sampled_reads = 0
+    sampled_bytes = 0
+    for window in range(windows):
+        window_start = data_start + int(window * stride)
+        window_end = data_start + int((window + 1) * stride)
+        if window:
+            # skip the rest of the record the window starts in, it belongs to the previous window; from one byte
+            # before the start, so that a record starting exactly at the window start is kept
+            handle.seek(window_start - 1)
+            handle.readline()
+        else:
+            handle.seek(window_start)
+        if max_reads:
+            reads_per_window = int(math.ceil(float(max_reads - sampled_reads) / (windows - window)))
+        window_reads = 0
+        window_bytes = 0
+        while handle.tell() < window_end:
+            if max_reads and window_reads >= reads_per_window:
+                break
+            if not max_reads and window_bytes >= bytes_per_window:
+                break
+            line = handle.readline()
+            if not line:
+                break
+            output_handle.write(line)
+            window_reads += 1
+            window_bytes += len(line)
+        sampled_reads += window_reads
+        sampled_bytes += window_bytes
+    handle.close()
+    output_handle.close()
+    sampled_fraction = float(sampled_bytes) / data_size if data_size else 1.0
+    estimated_reads = int(round(sampled_reads / sampled_fraction)) if sampled_bytes else 0
+    return {'reads': sampled_reads, 'fraction': sampled_fraction, 'estimated_reads': estimated_reads}
+
+
+def subsample_samples(directory, input_data_folder, fraction=None, max_reads=None):
+    """Samples every .sam file of input_data_folder into the preview input folder of the work folder."""
+    sam_files = get_sam_filelist(directory, input_data_folder)
+    if not len(sam_files):
+        click.echo(red_fg("\n>>> ERROR: No .sam files found in directory %s." % directory))
+        sys.exit(1)
+    preview_input_folder = preview_folder(input_data_folder)
+    for f in sam_files:
+        sampling = sample_sam_file(os.path.join(directory, input_data_folder, f),
+                                   os.path.join(directory, preview_input_folder, f), fraction, max_reads)
+        write_json_atomic(os.path.join(directory, preview_input_folder, f.replace(".sam", ".sampling.json")),
+                          sampling)
+        click.echo(yellow_fg(">>> Sampled %d reads (%.2f%%) of %s, about %d reads in total." %
+                             (sampling['reads'], sampling['fraction'] * 100, f, sampling['estimated_reads'])))
+    return preview_input_folder
+
+
+def wilson_interval(count, total, z=1.96):
+    """Wilson score interval of the proportion count/total (95% for the default z)."""
+    if total == 0:
+        return 0.0, 1.0
+    p = float(count) / total
+    denominator = 1 + z * z / total
+    centre = (p + z * z / (2 * total)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / total + z * z / (4.0 * total * total)) / denominator
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+
+def preview_report(directory, input_data_folder, blast_results_query_folder, top=10):
+    """Writes an approximate per-gene ppm table with 95% confidence intervals for every previewed sample.
+
+    ppm is estimated from the subsample; junction reads are extrapolated to the whole .sam file with the sampled
+    fraction. Windows of consecutive reads are sampled, so the intervals assume the reads are well mixed.
+    """
+    for db_file in sorted(get_file_list(directory, blast_results_query_folder, ".db")):
+        sample = os.path.splitext(db_file)[0]
+        sampling = read_json(os.path.join(directory, input_data_folder, sample + ".sampling.json"))
+        jdb = JunctionsDatabase(os.path.join(directory, blast_results_query_folder, db_file))
+        blast_count = jdb.db.execute_sql("SELECT blast_count FROM summary").fetchone()[0]
+        gene_counts = list(jdb.db.execute_sql(gene_counts_query))
+        jdb.close_db()
+        report_path = os.path.join(directory, blast_results_query_folder, sample + ".preview.txt")
+        report_handle = open(report_path, 'w')
+        report_handle.write("# APPROXIMATE: preview of %d reads (%.2f%%) of %s.sam, %d junction reads blasted\n" %
+                            (sampling['reads'], sampling['fraction'] * 100, sample, blast_count))
+        report_handle.write("\t".join(['gene_name', 'sampled_count', 'estimated_count', 'ppm', 'ppm_low_95',
+                                       'ppm_high_95']) + "\n")
+        rows = []
+        for gene_name, count in gene_counts:
+            low, high = wilson_interval(count, blast_count)
+            row = [gene_name, count, int(round(count / sampling['fraction'])), count * 1000000.0 / blast_count,
+                   low * 1000000.0, high * 1000000.0]
+            report_handle.write("%s\t%d\t%d\t%.2f\t%.2f\t%.2f\n" % tuple(row))
+            rows.append(row)
+        report_handle.close()
+        click.echo(magenta_fg("\n>>> APPROXIMATE preview of %s: %d junction reads in %d sampled reads "
+                              "(about %d junction reads in %d reads in total)" %
+                              (sample, blast_count, sampling['reads'],
+                               int(round(blast_count / sampling['fraction'])) if sampling['fraction'] else 0,
+                               sampling['estimated_reads'])))
+        for row in rows[:top]:
+            click.echo(yellow_fg("    %-16s %12.1f ppm  (95%% CI %.1f - %.1f)" % (row[0], row[3], row[4], row[5])))
+        click.echo(cyan_fg("    Full table written to %s" % report_path))
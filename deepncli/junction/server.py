@@ -0,0 +1,294 @@
+# project imports
+from ..utils.io import get_sam_filelist
+from .main import process_sample, load_gene_list, gene_list_cache
+# Other imports
+import os
+import sys
+import glob
+import json
+import time
+import click
+import socket
+import threading
+import multiprocessing
+from tqdm import tqdm
+from functools import partial
+from collections import Counter, OrderedDict
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+import warnings
+warnings.filterwarnings("ignore")
+
+
+green_fg = partial(click.style, fg='green')
+yellow_fg = partial(click.style, fg='yellow')
+magenta_fg = partial(click.style, fg='magenta')
+cyan_fg = partial(click.style, fg='cyan')
+red_fg = partial(click.style, fg='red')
+
+server_socket = os.path.join(os.path.expanduser('~'), ".deepn", "deepn.sock")  # Manage path of the server socket here
+READ_BLOCK = 1 << 20
+
+# set in every pool worker by init_worker
+progress_queue = None
+worker_budget = None
+
+
+def send_command(socket_path, command, **kwargs):
+    """Sends one JSON request to the server at socket_path and returns its JSON response."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(dict(kwargs, command=command)).encode('utf-8') + b'\n')
+        return json.loads(client.makefile('rb').readline().decode('utf-8'))
+    finally:
+        client.close()
+
+
+def server_running(socket_path):
+    try:
+        return send_command(socket_path, 'ping').get('ok', False)
+    except (socket.error, ValueError):
+        return False
+
+
+def warm_blast_db(db_name):
+    """Reads the files of a BLAST database once so that blastn finds them in the page cache.
+
+    blastn is a separate program and can not stay resident between jobs; its database files can.
+    """
+    warmed = 0
+    for path in sorted(glob.glob(os.path.join(os.path.expanduser('~'), ".deepn", db_name) + '*')):
+        with open(path, 'rb') as f:
+            block = f.read(READ_BLOCK)
+            while block:
+                warmed += len(block)
+                block = f.read(READ_BLOCK)
+    return warmed
+
+
+def init_worker(queue, budget):
+    global progress_queue, worker_budget
+    progress_queue = queue
+    worker_budget = budget
+
+
+def run_job(job_id, directory, settings, filename):
+    """Runs one sample in a pool worker. Returns the job id, the result or the error and the start of each stage."""
+    stages = []
+
+    def report(stage):
+        stages.append((stage, time.time()))
+        progress_queue.put((job_id, stage))
+
+    try:
+        return job_id, process_sample(directory, settings, filename, worker_budget, report), None, stages
+    except SystemExit as e:
+        # the reason was echoed to the server output by the stage that stopped
+        error = "stopped with exit code %s" % e.code
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+    return job_id, None, error, stages
+
+
+class JobTable(object):
+    """State, current stage, timestamps and per-stage seconds of every job submitted to the server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+
+    def add(self, directory, filename):
+        with self.lock:
+            job_id = "%d-%s" % (len(self.jobs) + 1, os.path.splitext(filename)[0])
+            self.jobs[job_id] = {'id': job_id, 'directory': directory, 'filename': filename, 'state': 'queued',
+                                 'stage': None, 'submitted': time.time(), 'started': None, 'finished': None,
+                                 'stages': [], 'result': None, 'error': None}
+        return job_id
+
+    def update_stage(self, job_id, stage):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['state'] in ('queued', 'running'):
+                job['state'] = 'running'
+                job['stage'] = stage
+                job['started'] = job['started'] or time.time()
+
+    def finish(self, job_id, result, error, stages):
+        with self.lock:
+            job = self.jobs[job_id]
+            job['finished'] = time.time()
+            job['state'] = 'failed' if error else 'done'
+            job['result'] = result
+            job['error'] = error
+            if len(stages):
+                job['started'] = stages[0][1]
+            ends = [start for stage, start in stages[1:]] + [job['finished']]
+            job['stages'] = [[stage, end - start] for (stage, start), end in zip(stages, ends)]
+
+    def status(self, job_ids=None):
+        with self.lock:
+            return [dict(self.jobs[job_id]) for job_id in (job_ids or self.jobs.keys()) if job_id in self.jobs]
+
+    def metrics(self):
+        with self.lock:
+            states = Counter(job['state'] for job in self.jobs.values())
+            stage_seconds = Counter()
+            for job in self.jobs.values():
+                if job['state'] == 'done':
+                    stage_seconds.update(dict(job['stages']))
+        return {'jobs': dict(states),
+                'mean_stage_seconds': dict((stage, seconds / states['done']) for stage, seconds in stage_seconds.items())}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = getattr(self.server, 'command_' + request.pop('command'))(**request)
+        except Exception as e:
+            response = {'ok': False, 'error': "%s: %s" % (type(e).__name__, e)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class DeepnServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves JSON requests (one line each) on a Unix socket and runs the submitted samples on a pool of workers.
+
+    The gene lists are read before the pool is forked, so every worker starts with them in its cache, and workers
+    live as long as the server, so lists loaded later for other genomes stay warm as well.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, workers, budget, warmed):
+        socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+        self.start = time.time()
+        self.workers = workers
+        self.warmed = warmed
+        self.jobs = JobTable()
+        self.progress = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(workers, init_worker, (self.progress, budget))
+        progress_thread = threading.Thread(target=self.read_progress)
+        progress_thread.daemon = True
+        progress_thread.start()
+
+    def read_progress(self):
+        while True:
+            job_id, stage = self.progress.get()
+            self.jobs.update_stage(job_id, stage)
+
+    def job_finished(self, job_result):
+        job_id, result, error, stages = job_result
+        self.jobs.finish(job_id, result, error, stages)
+        if error:
+            click.echo(red_fg("\n>>> ERROR: Job %s failed: %s" % (job_id, error)))
+        else:
+            click.echo(green_fg("\n>>> Finished job %s" % job_id))
+
+    def command_ping(self):
+        return dict(self.jobs.metrics(), ok=True, pid=os.getpid(), uptime=time.time() - self.start,
+                    workers=self.workers, gene_lists=sorted(set(path for path, mtime in gene_list_cache)),
+                    blast_dbs=self.warmed)
+
+    def command_submit(self, directory, settings, files):
+        if not os.path.isdir(directory):
+            return {'ok': False, 'error': "work folder %s does not exist on the server" % directory}
+        job_ids = []
+        for filename in files:
+            job_id = self.jobs.add(directory, filename)
+            self.pool.apply_async(run_job, (job_id, directory, settings, filename), callback=self.job_finished)
+            job_ids.append(job_id)
+        click.echo(cyan_fg("\n>>> Queued %d samples of %s: %s" % (len(job_ids), directory, ", ".join(job_ids))))
+        return {'ok': True, 'jobs': job_ids}
+
+    def command_status(self, jobs=None):
+        return {'ok': True, 'jobs': self.jobs.status(jobs)}
+
+    def command_shutdown(self):
+        threading.Thread(target=self.shutdown).start()
+        return {'ok': True}
+
+    def close(self):
+        # jobs that were already submitted are finished first
+        self.pool.close()
+        self.pool.join()
+        self.server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def run_server(socket_path, genomes, workers, budget=None):
+    """Loads the gene lists and BLAST databases of genomes ([(gene_list_file, blast_db), ...]) and serves jobs on
+    socket_path until a shutdown request."""
+    if os.path.exists(socket_path):
+        if server_running(socket_path):
+            click.echo(red_fg(">>> ERROR: A server is already running on %s." % socket_path))
+            sys.exit(1)
+        # left behind by a server that did not shut down cleanly
+        os.remove(socket_path)
+    warmed = {}
+    for gene_list_file, blast_db in genomes:
+        start = time.time()
+        load_gene_list(os.path.join(os.path.expanduser('~'), ".deepn", gene_list_file))
+        warmed[blast_db] = warm_blast_db(blast_db)
+        click.echo(yellow_fg(">>> Loaded %s and %s (%.1f MB) in %.1f sec" % (gene_list_file, blast_db,
+                                                                           warmed[blast_db] / 1e6,
+                                                                           time.time() - start)))
+    server = DeepnServer(socket_path, workers, budget, warmed)
+    click.echo(green_fg("\n>>> Serving on %s with %d workers (pid %d)" % (socket_path, workers, os.getpid())))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.pool.terminate()
+    server.close()
+    click.echo(cyan_fg("\n>>> Server on %s stopped." % socket_path))
+
+
+def submit_to_server(socket_path, directory, settings):
+    """Submits every .sam file of the work folder to the server and returns the job ids."""
+    sam_files = sorted(get_sam_filelist(directory, settings['input_data_folder']))
+    if not len(sam_files):
+        click.echo(red_fg("\n>>> ERROR: No .sam files found in directory %s." % directory))
+        sys.exit(1)
+    response = send_command(socket_path, 'submit', directory=os.path.abspath(directory), settings=settings,
+                            files=sam_files)
+    if not response['ok']:
+        click.echo(red_fg("\n>>> ERROR: The server on %s refused the samples: %s" % (socket_path, response['error'])))
+        sys.exit(1)
+    click.echo(cyan_fg("\n>>> Submitted %d samples to the server on %s." % (len(sam_files), socket_path)))
+    return response['jobs']
+
+
+def wait_for_jobs(socket_path, job_ids, poll_interval=1.0):
+    """Follows the jobs until they are finished, echoing their stages, and returns the ids of the failed jobs."""
+    bar = tqdm(total=len(job_ids), unit=' samples', desc="Server",
+               bar_format="{desc}: {percentage:3.0f}% | elapsed: {elapsed}, "
+                          "remaining: {remaining} | {rate_fmt}{postfix}")
+    stages = {}
+    finished = 0
+    while True:
+        jobs = send_command(socket_path, 'status', jobs=job_ids)['jobs']
+        for job in jobs:
+            if job['stage'] and job['stage'] != stages.get(job['id']):
+                stages[job['id']] = job['stage']
+                bar.write(magenta_fg(">>> Job %s: %s" % (job['id'], job['stage'])))
+        now_finished = len([job for job in jobs if job['state'] in ('done', 'failed')])
+        bar.update(now_finished - finished)
+        finished = now_finished
+        if finished == len(job_ids):
+            break
+        time.sleep(poll_interval)
+    bar.close()
+    failed = []
+    for job in jobs:
+        timings = ", ".join("%s %.1f sec" % tuple(item) for item in job['stages'])
+        if job['state'] == 'failed':
+            failed.append(job['id'])
+            click.echo(red_fg(">>> ERROR: Job %s failed: %s" % (job['id'], job['error'])))
+        else:
+            click.echo(yellow_fg(">>> Job %s: %d junctions, %d blast queries, %d accepted hits (%s)"
+                                 % (job['id'], job['result']['junctions'], job['result']['blast_queries'],
+                                    job['result']['accepted_hits'], timings)))
+    return failed
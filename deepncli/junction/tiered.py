@@ -0,0 +1,144 @@
+# project imports
+from ..api import iter_accepted_alignments
+# Other imports
+import click
+from functools import partial
+import warnings
+warnings.filterwarnings("ignore")
+
+
+green_fg = partial(click.style, fg='green')
+yellow_fg = partial(click.style, fg='yellow')
+magenta_fg = partial(click.style, fg='magenta')
+cyan_fg = partial(click.style, fg='cyan')
+red_fg = partial(click.style, fg='red')
+
+# suffixes of the files of a tiered BLAST next to <sample>.blast.txt (not picked up as .fa/.txt files)
+first_pass_suffix = '.first_pass.out'
+misses_query_suffix = '.misses.fasta'
+misses_output_suffix = '.misses.out'
+single_pass_suffix = '.single_pass.out'
+report_suffix = '.tier_report.tsv'
+
+
+def blast_blocks(lines):
+    """Yields (query, lines) for every query of BLAST -outfmt 7 output. The closing `# BLAST processed` line is
+    dropped, merged outputs get a new one."""
+    query = None
+    block = []
+    for line in lines:
+        if line.startswith("# BLASTN"):
+            if len(block):
+                yield query, block
+            query = None
+            block = [line]
+        elif line.startswith("# BLAST processed"):
+            continue
+        else:
+            if line.startswith("# Query: "):
+                query = line.split()[2]
+            block.append(line)
+    if len(block):
+        yield query, block
+
+
+def accepted_alignments(block):
+    """(nm_number, position, query_start) of the alignments of one query block accepted by the parser."""
+    return tuple((split[1], int(split[8]), int(split[6])) for split in iter_accepted_alignments(block))
+
+
+def missed_queries(blast_output):
+    """Positions of the queries, in query order, without an accepted alignment in BLAST output.
+
+    Queries are taken by position and not by name: both unmapped mates of a pair have the same read name.
+    """
+    with open(blast_output) as handle:
+        return [position for position, (query, block) in enumerate(blast_blocks(handle))
+                if not len(accepted_alignments(block))]
+
+
+def write_queries(fasta_path, output_path, positions):
+    """Copies the FASTA records at the given positions (and only those) from fasta_path to output_path."""
+    positions = set(positions)
+    position = -1
+    keep = False
+    with open(fasta_path) as handle, open(output_path, 'w') as output_handle:
+        for line in handle:
+            if line.startswith(">"):
+                position += 1
+                keep = position in positions
+            if keep:
+                output_handle.write(line)
+
+
+def merge_blast_outputs(first_output, misses_output, output_file):
+    """Writes the first pass output with the blocks of the missed queries replaced by their sensitive pass blocks.
+
+    Both passes keep the order of the queries, so the missed blocks are taken in turn. Returns the number of queries.
+    """
+    queries = 0
+    with open(first_output) as first_handle, open(misses_output) as misses_handle, \
+            open(output_file, 'w') as output_handle:
+        misses = blast_blocks(misses_handle)
+        for query, block in blast_blocks(first_handle):
+            if not len(accepted_alignments(block)):
+                missed_query, block = next(misses, (None, None))
+                if missed_query != query:
+                    raise ValueError("sensitive BLAST output is out of order: %s instead of %s"
+                                     % (missed_query, query))
+            output_handle.writelines(block)
+            queries += 1
+        left = len(list(misses))
+        if left:
+            raise ValueError("sensitive BLAST output has %d more queries than the first pass missed" % left)
+        output_handle.write("# BLAST processed %d queries\n" % queries)
+    return queries
+
+
+def accepted_by_query(blast_output):
+    with open(blast_output) as handle:
+        return [(query, accepted_alignments(block)) for query, block in blast_blocks(handle)]
+
+
+def compare_passes(tiered_output, single_output):
+    """Compares the accepted alignments of the tiered and of the single sensitive pass, query by query (in order,
+    mates share a name)."""
+    tiered = accepted_by_query(tiered_output)
+    single = accepted_by_query(single_output)
+    if [query for query, hits in tiered] != [query for query, hits in single]:
+        raise ValueError("the tiered and the single pass BLAST output have different queries")
+    counts = {'queries': len(single), 'same_queries': 0, 'tiered_hits': 0, 'single_hits': 0, 'same_hits': 0}
+    differences = []
+    for (query, tiered_hits), (query, single_hits) in zip(tiered, single):
+        counts['tiered_hits'] += len(tiered_hits)
+        counts['single_hits'] += len(single_hits)
+        counts['same_hits'] += len(set(tiered_hits) & set(single_hits))
+        if set(tiered_hits) == set(single_hits):
+            counts['same_queries'] += 1
+        else:
+            differences.append((query, tiered_hits, single_hits))
+    return counts, differences
+
+
+def write_tier_report(report_path, name, timings, missed, counts, differences):
+    """Writes the agreement of the tiered and single pass BLAST of a sample and echoes a summary."""
+    agreement = counts['same_hits'] * 100.0 / counts['single_hits'] if counts['single_hits'] else 100.0
+    report_handle = open(report_path, 'w')
+    report_handle.write("# tiered BLAST of %s: first pass %.1f sec, sensitive pass of %d missed queries %.1f sec, "
+                        "single sensitive pass %.1f sec\n" % (name, timings['first_pass'], missed,
+                                                               timings['misses'], timings['single_pass']))
+    report_handle.write("# %d of %d queries and %d of %d accepted hits agree (%d tiered hits)\n"
+                        % (counts['same_queries'], counts['queries'], counts['same_hits'], counts['single_hits'],
+                           counts['tiered_hits']))
+    report_handle.write("\t".join(['query', 'tiered_hits', 'single_pass_hits']) + "\n")
+    for query, tiered_hits, single_hits in differences:
+        report_handle.write("%s\t%s\t%s\n" % (query, ",".join("%s:%d:%d" % hit for hit in tiered_hits),
+                                              ",".join("%s:%d:%d" % hit for hit in single_hits)))
+    report_handle.close()
+    tiered_seconds = timings['first_pass'] + timings['misses']
+    click.echo(magenta_fg("\n>>> Tiered BLAST of %s: %.1f sec (%.1fx faster than a single pass), "
+                          "%.2f%% of the accepted hits agree" %
+                          (name, tiered_seconds, timings['single_pass'] / tiered_seconds if tiered_seconds else 0,
+                           agreement)))
+    if len(differences):
+        click.echo(red_fg("    %d queries differ from the single pass, see %s" % (len(differences), report_path)))
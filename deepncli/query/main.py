@@ -0,0 +1,108 @@
+# project imports
+from ..db.junctiondb import JunctionsDatabase
+from ..db.experimentdb import ExperimentDatabase
+from ..utils.io import get_file_list
+# Other imports
+import os
+import sys
+import time
+import click
+from functools import partial
+from collections import Counter, OrderedDict
+import warnings
+warnings.filterwarnings("ignore")
+
+
+green_fg = partial(click.style, fg='green')
+yellow_fg = partial(click.style, fg='yellow')
+magenta_fg = partial(click.style, fg='magenta')
+cyan_fg = partial(click.style, fg='cyan')
+red_fg = partial(click.style, fg='red')
+
+junction_columns = ['nm_number', 'position', 'query_start', 'frame', 'orf', 'count', 'ppm']
+
+# junctions of a gene (all its transcripts) or of a single transcript, each side served by a covering index
+sample_junctions_query = ("SELECT j.nm_number, j.position, j.query_start, j.frame, j.orf, j.count, j.ppm "
+                          "FROM gene g JOIN junction j ON j.gene_id = g.id WHERE g.gene_name = ? "
+                          "UNION ALL "
+                          "SELECT j.nm_number, j.position, j.query_start, j.frame, j.orf, j.count, j.ppm "
+                          "FROM junction j WHERE j.nm_number = ? ORDER BY 2, 3")
+
+# databases written before junctions stored their NM number only know the gene, an NM number selects its gene
+legacy_junctions_query = ("SELECT g.nm_number, j.position, j.query_start, j.frame, j.orf, j.count, j.ppm "
+                          "FROM gene g JOIN junction j ON j.gene_id = g.id "
+                          "WHERE g.gene_name = ? OR g.gene_name IN (SELECT gene_name FROM gene WHERE nm_number = ?) "
+                          "ORDER BY j.position, j.query_start")
+
+experiment_junctions_query = ("SELECT s.name, j.nm_number, j.position, j.query_start, j.frame, j.orf, j.count, j.ppm "
+                              "FROM sample_junction j JOIN sample s ON s.id = j.sample_id "
+                              "WHERE j.gene_name = ? OR j.nm_number = ? "
+                              "ORDER BY s.name, j.position, j.query_start")
+
+
+def gene_stats(junctions):
+    """Counts the junctions of a gene per frame/orf label like the Stats table, plus the total ppm."""
+    stats = Counter()
+    for junction in junctions:
+        stats[junction[3]] += 1
+        stats[junction[4]] += 1
+        if junction[3] == 'in_frame' and junction[4] == 'in_orf':
+            stats['inframe_inorf'] += 1
+    stats['total'] = len(junctions)
+    stats['ppm'] = sum(junction[6] for junction in junctions)
+    return stats
+
+
+def find_gene_junctions(directory, blast_results_query_folder, compare_folder, gene):
+    """Returns {sample: [junction rows]} for a gene name or NM number, and the name of the database(s) used.
+
+    The experiment store written by `deepn compare` is used when it exists and no sample database is newer than
+    it, otherwise every sample database.
+    """
+    results = OrderedDict()
+    store_path = os.path.join(directory, compare_folder, "experiment.db")
+    sample_files = sorted(get_file_list(directory, blast_results_query_folder, ".db"))
+    store_current = os.path.exists(store_path)
+    if store_current:
+        newer = [f for f in sample_files if os.path.getmtime(os.path.join(directory, blast_results_query_folder, f))
+                 > os.path.getmtime(store_path)]
+        if len(newer):
+            click.echo(red_fg(">>> WARNING: %s is older than %d sample databases (%s), run deepn compare again to "
+                              "update it. Querying the sample databases instead."
+                              % (store_path, len(newer), ", ".join(newer))))
+            store_current = False
+    if store_current:
+        edb = ExperimentDatabase(store_path)
+        for row in edb.db.execute_sql("SELECT name FROM sample ORDER BY name"):
+            results[row[0]] = []
+        for row in edb.db.execute_sql(experiment_junctions_query, (gene, gene)):
+            results[row[0]].append(row[1:])
+        edb.close_db()
+        return results, store_path
+    for sample_file in sample_files:
+        jdb = JunctionsDatabase(os.path.join(directory, blast_results_query_folder, sample_file))
+        query = sample_junctions_query if jdb.has_junction_nm_number() else legacy_junctions_query
+        results[os.path.splitext(sample_file)[0]] = list(jdb.db.execute_sql(query, (gene, gene)))
+        jdb.close_db()
+    return results, blast_results_query_folder
+
+
+def query_gene(directory, blast_results_query_folder, compare_folder, gene, show_junctions=True):
+    start = time.time()
+    results, source = find_gene_junctions(directory, blast_results_query_folder, compare_folder, gene)
+    if not len(results):
+        click.echo(red_fg("\n>>> ERROR: No sample databases found in folder %s." % blast_results_query_folder))
+        sys.exit(1)
+    for sample, junctions in results.items():
+        stats = gene_stats(junctions)
+        click.echo(magenta_fg("\n>>> %s in %s: %d junctions, %.2f ppm" % (gene, sample, stats['total'],
+                                                                          stats['ppm'])))
+        click.echo(yellow_fg("    " + ", ".join("%s %d" % (label, stats[label])
+                                                for label in ['inframe_inorf', 'in_frame', 'not_in_frame', 'intron',
+                                                              'backwards', 'in_orf', 'upstream', 'downstream'])))
+        if show_junctions and len(junctions):
+            click.echo(cyan_fg("    " + "\t".join(junction_columns)))
+            for junction in junctions:
+                click.echo("    " + "\t".join([str(c) for c in junction[:6]] + ["%.4f" % junction[6]]))
+    click.echo(green_fg("\n>>> Queried %d samples from %s in %.1f ms" % (len(results), source,
+                                                                       (time.time() - start) * 1000)))
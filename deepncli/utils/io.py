@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+from __future__ import absolute_import
+import io
 import os
 import sys
+import time
+import gzip
 import click
 from functools import partial
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 green_fg = partial(click.style, fg='green')
 yellow_fg = partial(click.style, fg='yellow')
@@ -11,6 +19,9 @@ magenta_fg = partial(click.style, fg='magenta')
 cyan_fg = partial(click.style, fg='cyan')
 red_fg = partial(click.style, fg='red')
 
+WRITE_BUFFER_SIZE = 1024 * 1024
+compression_suffixes = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
 
 def count_lines(filename):
     f = open(filename)
@@ -25,6 +36,85 @@ def count_lines(filename):
     return lines
 
 
+def split_on_headers(filename, header, chunks, min_chunk_bytes=8 * 1024 * 1024):
+    """Splits a file into at most `chunks` (start, end) byte ranges that each begin at a line starting with header.
+
+    Chunks are at least min_chunk_bytes long (except the last), so small files are not split.
+    """
+    size = os.path.getsize(filename)
+    chunks = max(1, min(chunks, size // min_chunk_bytes))
+    header = header.encode('utf-8')
+    offsets = [0]
+    handle = open(filename, 'rb')
+    for i in range(1, chunks):
+        handle.seek(max(i * size // chunks, offsets[-1]))
+        handle.readline()
+        offset = handle.tell()
+        line = handle.readline()
+        while line and not line.startswith(header):
+            offset = handle.tell()
+            line = handle.readline()
+        if not line:
+            break
+        if offset > offsets[-1]:
+            offsets.append(offset)
+    handle.close()
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_lines(filename, start, end):
+    """Yields the text lines of a file between the byte offsets start and end."""
+    handle = open(filename, 'rb')
+    handle.seek(start)
+    position = start
+    for line in handle:
+        if position >= end:
+            break
+        position += len(line)
+        yield line if str is bytes else line.decode('utf-8')
+    handle.close()
+
+
+def progress_lines(lines, bar, every=4096):
+    """Yields lines and advances the tqdm bar by their size in bytes, updating it every `every` lines."""
+    size = 0
+    for i, line in enumerate(lines):
+        size += len(line)
+        if i % every == 0:
+            bar.update(size)
+            size = 0
+        yield line
+    bar.update(size)
+
+
+def follow_lines(filehandle, follow_timeout, poll_interval=1.0):
+    """Yields the complete lines of a file that is still being written (like tail -f).
+
+    Stops when no new data has arrived for follow_timeout seconds.
+    """
+    partial_line = ''
+    last_data = time.time()
+    while True:
+        position = filehandle.tell()
+        line = filehandle.readline()
+        if line:
+            last_data = time.time()
+            if line.endswith('\n'):
+                yield partial_line + line
+                partial_line = ''
+            else:
+                partial_line += line
+        elif time.time() - last_data >= follow_timeout:
+            break
+        else:
+            time.sleep(poll_interval)
+            # clears the end of file state so that data appended since is read
+            filehandle.seek(position)
+    if partial_line:
+        yield partial_line
+
+
 def check_and_create_folders(directory, folder_list, interactive=False):
     for folder in folder_list:
         if os.path.exists(os.path.join(directory, folder)):
@@ -55,19 +145,20 @@ def get_sam_filelist(directory, input_folder):
     return file_list
 
 
-def make_fasta_file(junction_file, output_file):
-    counter = 0
-    input_file = open(junction_file, 'r')
-    output_file = open(output_file, 'w')
-    for line in input_file:
-        line.strip()
-        split = line.split()
-        output_file.write(">%s\n%s\n" % (str(split[0]), str(split[5])))
-        counter += 1
-    input_file.close()
-    output_file.close()
-    click.echo(magenta_fg('>>> Converted  %d junctions '
-                          'in %s to a FASTA file.' % (counter, os.path.split(junction_file)[-1])))
+def compression_available(compression):
+    return compression != 'zstd' or zstandard is not None
+
+
+def open_output(path, compression='none'):
+    """Opens a buffered text writer for path, compressed and suffixed according to compression (none/gzip/zstd)."""
+    path += compression_suffixes[compression]
+    if compression == 'gzip':
+        # on python 2 str is bytes and the binary writer takes it as is
+        return gzip.open(path, 'wb' if str is bytes else 'wt', 6)
+    if compression == 'zstd':
+        writer = zstandard.ZstdCompressor().stream_writer(open(path, 'wb', WRITE_BUFFER_SIZE))
+        return writer if str is bytes else io.TextIOWrapper(writer, encoding='utf-8')
+    return open(path, 'w', WRITE_BUFFER_SIZE)
 
 
 def concatenate_dicts(list):
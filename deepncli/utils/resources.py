@@ -0,0 +1,211 @@
+from __future__ import absolute_import
+import os
+import time
+import errno
+import socket
+import subprocess
+import distutils.spawn
+from collections import defaultdict
+from contextlib import contextmanager
+import joblib.parallel as parallel
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def psutil_affinity():
+    # psutil has no cpu_affinity on macOS
+    return psutil is not None and hasattr(psutil.Process, 'cpu_affinity')
+
+
+def affinity_supported():
+    return hasattr(os, 'sched_setaffinity') or psutil_affinity()
+
+
+def set_affinity(cores, pid=0):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, cores)
+    elif psutil_affinity():
+        psutil.Process(pid or os.getpid()).cpu_affinity(list(cores))
+
+
+class CoreBudget(object):
+    """Hands out core tokens to the workers and blastn processes of one run under a budget of `cores`.
+
+    Tokens are files core-<n>.lock in a per-node folder (~/.deepn/cores/<hostname>) created with O_EXCL, so all
+    runs on a node together never hold more tokens than the node has cores. Every token is held together with one
+    of `cores` run slots (run-<pid>/slot-<n>.lock), which the worker processes of the run share, so the run never
+    holds more than its budget. A token or slot whose owner process has exited is reclaimed. The core-seconds held
+    in every stage are appended to a usage file for the utilisation report.
+    """
+
+    def __init__(self, cores, pin=False, token_folder=None, node_cores=None):
+        self.node_cores = node_cores or parallel.cpu_count()
+        self.cores = max(1, min(int(cores), self.node_cores))
+        self.pin = pin and affinity_supported()
+        # without affinity support in python, blastn can still be pinned through taskset
+        self.taskset = pin and not self.pin and distutils.spawn.find_executable('taskset') is not None
+        self.token_folder = token_folder or os.path.join(os.path.expanduser('~'), ".deepn", "cores",
+                                                         socket.gethostname())
+        self.run_folder = os.path.join(self.token_folder, "run-%d" % os.getpid())
+        if not os.path.exists(self.run_folder):
+            try:
+                os.makedirs(self.run_folder)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.usage_path = os.path.join(self.token_folder, "usage-%d.txt" % os.getpid())
+        # run slot held with each core token taken by this process
+        self.slots = {}
+
+    def token_path(self, core):
+        return os.path.join(self.token_folder, "core-%d.lock" % core)
+
+    def slot_path(self, slot):
+        return os.path.join(self.run_folder, "slot-%d.lock" % slot)
+
+    def _take(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                with open(path) as f:
+                    owner = int(f.read() or 0)
+            except (IOError, OSError, ValueError):
+                return False
+            if owner and not pid_alive(owner):
+                stale_path = "%s.stale-%d" % (path, os.getpid())
+                try:
+                    # only one process can rename the stale token away
+                    os.rename(path, stale_path)
+                    with open(stale_path) as f:
+                        renamed_owner = int(f.read() or 0)
+                except (IOError, OSError, ValueError):
+                    return False
+                if renamed_owner != owner and (not renamed_owner or pid_alive(renamed_owner)):
+                    # reclaimed by another process between the check and the rename: hand it back to its owner
+                    try:
+                        os.link(stale_path, path)
+                    except OSError:
+                        pass
+                    os.remove(stale_path)
+                    return False
+                os.remove(stale_path)
+                return self._take(path)
+            return False
+        os.write(fd, str(os.getpid()).encode('utf-8'))
+        os.close(fd)
+        return True
+
+    def _remove(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def acquire(self, n=1, poll_interval=0.5):
+        """Blocks until a run slot and a token are free and returns the ids of up to n (at most `cores`) cores.
+
+        Slots are taken first; slots without a free token are handed back before waiting, so nothing is held while
+        blocking.
+        """
+        n = max(1, min(n, self.cores))
+        while True:
+            slots = []
+            for slot in range(self.cores):
+                if self._take(self.slot_path(slot)):
+                    slots.append(slot)
+                    if len(slots) == n:
+                        break
+            cores = []
+            for core in range(self.node_cores):
+                if len(cores) == len(slots):
+                    break
+                if self._take(self.token_path(core)):
+                    cores.append(core)
+            # slots without a free token are handed back
+            self._remove(self.slot_path(slot) for slot in slots[len(cores):])
+            if len(cores):
+                self.slots.update(zip(cores, slots))
+                return cores
+            time.sleep(poll_interval)
+
+    def release(self, cores):
+        self._remove(self.token_path(core) for core in cores)
+        self._remove(self.slot_path(self.slots.pop(core)) for core in cores if core in self.slots)
+
+    @contextmanager
+    def tokens(self, stage, n=1, pin_self=False):
+        cores = self.acquire(n)
+        start = time.time()
+        if pin_self and self.pin:
+            set_affinity(cores)
+        try:
+            yield cores
+        finally:
+            self.release(cores)
+            with open(self.usage_path, 'a') as f:
+                f.write("%s %d %f\n" % (stage, len(cores), time.time() - start))
+
+    def popen(self, command_list, cores, **kwargs):
+        """Starts a subprocess restricted to the given cores when pinning is enabled."""
+        if self.pin:
+            return subprocess.Popen(command_list, preexec_fn=lambda: set_affinity(cores), **kwargs)
+        if self.taskset:
+            command_list = ['taskset', '-c', ",".join(str(c) for c in cores)] + command_list
+        return subprocess.Popen(command_list, **kwargs)
+
+    def usage(self):
+        core_seconds = defaultdict(float)
+        if os.path.exists(self.usage_path):
+            with open(self.usage_path) as f:
+                for line in f:
+                    stage, cores, seconds = line.split()
+                    core_seconds[stage] += int(cores) * float(seconds)
+        return core_seconds
+
+    def report(self, wall_time):
+        """Returns (stage, core_seconds, utilisation) rows, utilisation being relative to the budget over wall_time."""
+        rows = []
+        capacity = max(wall_time, 1e-6) * self.cores
+        for stage, seconds in sorted(self.usage().items()):
+            rows.append((stage, seconds, seconds / capacity))
+        return rows
+
+    def close(self):
+        if os.path.exists(self.usage_path):
+            os.remove(self.usage_path)
+        if os.path.isdir(self.run_folder):
+            self._remove(os.path.join(self.run_folder, f) for f in os.listdir(self.run_folder))
+            try:
+                os.rmdir(self.run_folder)
+            except OSError:
+                pass
+
+
+@contextmanager
+def budget_tokens(budget, stage, n=1, pin_self=False):
+    """Holds up to n core tokens of budget, or yields all the cores of the node when there is no budget."""
+    if budget is None:
+        yield list(range(parallel.cpu_count()))
+    else:
+        with budget.tokens(stage, n, pin_self) as cores:
+            yield cores
+
+
+def run_with_cores(budget, stage, function, *args):
+    """Runs function(*args) while holding one core token of the budget (used for joblib workers)."""
+    with budget_tokens(budget, stage, 1, pin_self=True):
+        return function(*args)
@@ -0,0 +1,185 @@
+from __future__ import absolute_import
+import os
+import json
+import time
+import errno
+import socket
+import threading
+
+
+def default_worker_id():
+    return "%s-%d" % (socket.gethostname(), os.getpid())
+
+
+def write_json_atomic(path, data):
+    temp_path = "%s.%s.tmp" % (path, default_worker_id())
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(temp_path, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class Heartbeat(threading.Thread):
+    """Touches a lease file every `interval` seconds until stopped, so other workers know it is still alive.
+
+    Only `stop` ends the thread, a failed touch is retried at the next beat.
+    """
+
+    def __init__(self, lease_path, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.lease_path = lease_path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.lease_path, None)
+            except OSError:
+                # the lease may be renamed away for a moment by a worker checking it for staleness; keep beating
+                continue
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class WorkQueue(object):
+    """A task queue kept in a folder on a shared filesystem.
+
+    tasks/<id>.json are written by the coordinator. A worker claims a task by creating leases/<id>.lease with
+    O_EXCL and keeps touching it while it works; a lease that has not been touched for `lease_timeout` seconds is
+    stale and is taken over by the next worker. Finished tasks are recorded in done/<id>.json or failed/<id>.json.
+    """
+
+    def __init__(self, directory, lease_timeout=300, heartbeat_interval=30):
+        self.directory = directory
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.task_folder = os.path.join(directory, 'tasks')
+        self.lease_folder = os.path.join(directory, 'leases')
+        self.done_folder = os.path.join(directory, 'done')
+        self.failed_folder = os.path.join(directory, 'failed')
+
+    def create(self):
+        for folder in [self.task_folder, self.lease_folder, self.done_folder, self.failed_folder]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+    def put(self, task_id, payload):
+        write_json_atomic(os.path.join(self.task_folder, task_id + '.json'), payload)
+
+    def task_ids(self):
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.task_folder) if f.endswith('.json'))
+
+    def done_ids(self):
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.done_folder) if f.endswith('.json'))
+
+    def failed_ids(self):
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.failed_folder) if f.endswith('.json'))
+
+    def pending_ids(self):
+        finished = set(self.done_ids()) | set(self.failed_ids())
+        return [t for t in self.task_ids() if t not in finished]
+
+    def result(self, task_id):
+        if os.path.exists(os.path.join(self.done_folder, task_id + '.json')):
+            return read_json(os.path.join(self.done_folder, task_id + '.json'))
+        return read_json(os.path.join(self.failed_folder, task_id + '.json'))
+
+    def lease_path(self, task_id):
+        return os.path.join(self.lease_folder, task_id + '.lease')
+
+    def _create_lease(self, task_id, worker_id):
+        try:
+            fd = os.open(self.lease_path(task_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, worker_id.encode('utf-8'))
+        os.close(fd)
+        return True
+
+    def _break_stale_lease(self, task_id, worker_id):
+        lease_path = self.lease_path(task_id)
+        try:
+            if time.time() - os.stat(lease_path).st_mtime < self.lease_timeout:
+                return False
+            stale_path = "%s.stale-%s" % (lease_path, worker_id)
+            # only one worker can rename the stale lease away
+            os.rename(lease_path, stale_path)
+        except OSError:
+            return False
+        if time.time() - os.stat(stale_path).st_mtime < self.lease_timeout:
+            # the lease was renewed between the check and the rename: hand it back to its owner
+            try:
+                os.link(stale_path, lease_path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def claim(self, worker_id):
+        """Leases the first pending task and returns (task_id, payload), or None when nothing can be claimed."""
+        for task_id in self.pending_ids():
+            if self._create_lease(task_id, worker_id) or \
+                    (self._break_stale_lease(task_id, worker_id) and self._create_lease(task_id, worker_id)):
+                if task_id not in self.pending_ids():
+                    # finished by another worker while we were claiming it
+                    self.release(task_id)
+                    continue
+                return task_id, read_json(os.path.join(self.task_folder, task_id + '.json'))
+        return None
+
+    def release(self, task_id):
+        try:
+            os.remove(self.lease_path(task_id))
+        except OSError:
+            pass
+
+    def complete(self, task_id, result):
+        write_json_atomic(os.path.join(self.done_folder, task_id + '.json'), result)
+        self.release(task_id)
+
+    def fail(self, task_id, result):
+        write_json_atomic(os.path.join(self.failed_folder, task_id + '.json'), result)
+        self.release(task_id)
+
+    def run_worker(self, handler, worker_id=None, wait=False, poll_interval=10, on_claim=None):
+        """Claims and runs tasks with handler(task_id, payload) until the queue is drained.
+
+        With wait=True the worker keeps polling while other workers still hold leases, so it can pick up their
+        tasks if they die. Returns the ids of the tasks processed by this worker.
+        """
+        worker_id = worker_id or default_worker_id()
+        processed = []
+        while True:
+            claimed = self.claim(worker_id)
+            if claimed is None:
+                if not wait or not self.pending_ids():
+                    return processed
+                time.sleep(poll_interval)
+                continue
+            task_id, payload = claimed
+            if on_claim:
+                on_claim(task_id)
+            heartbeat = Heartbeat(self.lease_path(task_id), self.heartbeat_interval)
+            heartbeat.start()
+            start = time.time()
+            try:
+                result = handler(task_id, payload)
+            except (Exception, SystemExit) as e:
+                heartbeat.stop()
+                self.fail(task_id, {'worker': worker_id, 'error': repr(e), 'elapsed': time.time() - start})
+            else:
+                heartbeat.stop()
+                self.complete(task_id, {'worker': worker_id, 'result': result, 'elapsed': time.time() - start})
+            processed.append(task_id)
@@ -65,7 +65,8 @@ setup(
     include_package_data=True,
     keywords='deepncli',
     name='deepncli',
-    packages=find_packages(include=['deepncli', 'deepncli.db', 'deepncli.junction', 'deepncli.utils'],
+    packages=find_packages(include=['deepncli', 'deepncli.db', 'deepncli.junction', 'deepncli.compare',
+                                    'deepncli.query', 'deepncli.utils'],
                            exclude=['deepncli.data']),
     setup_requires=setup_requirements,
     test_suite='tests',
@@ -36,3 +36,550 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+def test_junction_counter_spills_and_merges(tmpdir):
+    """Test that spilled junction counts are merged back by key."""
+    from deepncli.junction.aggregate import JunctionCounter
+    counter = JunctionCounter(spill_directory=str(tmpdir))
+    counter.max_entries = 2
+    for nm_number, position in [('NM_1', 10), ('NM_2', 5), ('NM_1', 10), ('NM_3', 7), ('NM_2', 5), ('NM_1', 10)]:
+        counter.add(nm_number, 'in_frame', 'in_orf', position, 1)
+    assert len(counter.spill_files) > 0
+    counts = dict((counter.decode(key), count) for key, count in counter.items())
+    assert counts == {('NM_1', 'in_frame', 'in_orf', 10, 1): 3,
+                      ('NM_2', 'in_frame', 'in_orf', 5, 1): 2,
+                      ('NM_3', 'in_frame', 'in_orf', 7, 1): 1}
+    counter.close()
+    assert not tmpdir.listdir()
+
+
+def test_mismatch_matcher_finds_substituted_junction():
+    """Test that a junction with one sequencing error is found with its mismatch count."""
+    from deepncli.api import make_search_junctions, junctions_in_read
+    from deepncli.junction.mismatch import MismatchMatcher
+    jseqs = make_search_junctions([cli.junction_sequences['hg38']])
+    read = "TTTTGACA" + jseqs[0] + "ACGTACGTACGTACGTACGTACGTACGTACGT"
+    assert MismatchMatcher(jseqs, 1).search(read) == (0, 8, 0)
+    error_read = read[:12] + ("A" if read[12] != "A" else "C") + read[13:]
+    assert junctions_in_read(error_read, jseqs) == (-1, -1)
+    assert MismatchMatcher(jseqs, 1).search(error_read) == (0, 8, 1)
+    assert MismatchMatcher(jseqs, 1).search("ACGT" * 30) == (-1, -1, -1)
+    # the screen stops paying off beyond 2 mismatches
+    with pytest.raises(ValueError):
+        MismatchMatcher(jseqs, 3)
+
+
+def test_exact_reverse_junction_wins_over_approximate_forward_match():
+    """Test that exact matches are tried in both orientations before a match with mismatches is accepted."""
+    from deepncli import api
+    from deepncli.junction.proteinprocessor import ProteinProcessor
+    junction = cli.junction_sequences['hg38']
+    forward = junction[:40] + ("A" if junction[40] != "A" else "C") + junction[41:] + "ACGTTGCA" * 5
+    reverse = ProteinProcessor().reverse_complement(junction + "GGCCTTAA" * 5)
+    read = "read1\t4\t*\t0\t0\t*\t*\t0\t0\t%s\t*\n" % (forward + reverse)
+    hits = list(api.iter_junctions([read], [junction], max_mismatches=1))
+    assert len(hits) == 1 and hits[0].reverse and hits[0].mismatches == 0
+    assert hits[0].downstream.startswith("GGCCTTAA")
+
+
+def _record_task(task_id, payload):
+    return {'value': payload['value'] * 2}
+
+
+def test_work_queue_with_several_processes(tmpdir):
+    """Test that local worker processes share the queue and each task is done exactly once."""
+    import multiprocessing
+    from deepncli.utils.workqueue import WorkQueue
+    queue = WorkQueue(str(tmpdir))
+    queue.create()
+    for i in range(20):
+        queue.put('task%02d' % i, {'value': i})
+    workers = [multiprocessing.Process(target=queue.run_worker, args=(_record_task, 'worker%d' % i))
+               for i in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert queue.done_ids() == queue.task_ids()
+    assert queue.pending_ids() == [] and queue.failed_ids() == []
+    assert [queue.result(t)['result']['value'] for t in queue.done_ids()] == [i * 2 for i in range(20)]
+    assert tmpdir.join('leases').listdir() == []
+
+
+def test_work_queue_recovers_stale_lease(tmpdir):
+    """Test that a lease without heartbeats is taken over by another worker."""
+    import os
+    from deepncli.utils.workqueue import WorkQueue
+    queue = WorkQueue(str(tmpdir), lease_timeout=60)
+    queue.create()
+    queue.put('sample', {'value': 1})
+    assert queue.claim('dead_worker')[0] == 'sample'
+    assert queue.claim('other_worker') is None
+    os.utime(queue.lease_path('sample'), (0, 0))
+    assert queue.claim('other_worker')[0] == 'sample'
+    assert tmpdir.join('leases', 'sample.lease').read() == 'other_worker'
+
+
+def test_heartbeat_survives_a_lease_that_is_briefly_missing(tmpdir):
+    """Test that the heartbeat keeps touching the lease after it was renamed away for a moment."""
+    import os
+    import time
+    from deepncli.utils.workqueue import Heartbeat
+    lease = tmpdir.join('sample.lease')
+    heartbeat = Heartbeat(str(lease), 0.05)
+    heartbeat.start()
+    time.sleep(0.2)
+    assert heartbeat.is_alive()
+    lease.write('worker')
+    os.utime(str(lease), (0, 0))
+    time.sleep(0.2)
+    heartbeat.stop()
+    assert not heartbeat.is_alive() and lease.mtime() > 0
+
+
+def test_core_budget_reclaims_tokens_of_dead_processes(tmpdir):
+    """Test that core tokens left behind by exited processes are reclaimed and usage is reported."""
+    import subprocess
+    from deepncli.utils.resources import CoreBudget
+    budget = CoreBudget(1, token_folder=str(tmpdir))
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    tmpdir.join('core-0.lock').write(str(dead.pid))
+    with budget.tokens('search') as cores:
+        assert cores == [0]
+        assert tmpdir.join('core-0.lock').check()
+    assert not tmpdir.join('core-0.lock').check()
+    assert [stage for stage, core_seconds, utilisation in budget.report(1.0)] == ['search']
+    budget.close()
+
+
+def test_core_budget_blocks_beyond_the_cores_of_the_run(tmpdir):
+    """Test that a run never holds more tokens than its budget, even when the node has free cores."""
+    import threading
+    from deepncli.utils.resources import CoreBudget
+    budget = CoreBudget(2, token_folder=str(tmpdir), node_cores=8)
+    first = budget.acquire(1)
+    second = budget.acquire(1)
+    third = []
+    waiting = threading.Thread(target=lambda: third.append(budget.acquire(1, poll_interval=0.05)))
+    waiting.start()
+    waiting.join(0.3)
+    assert waiting.is_alive() and third == []
+    assert len(tmpdir.listdir(lambda p: p.basename.startswith('core-'))) == 2
+    budget.release(first)
+    waiting.join(2)
+    assert third == [first]
+    budget.release(second)
+    budget.release(third[0])
+    budget.close()
+    assert tmpdir.listdir() == []
+
+
+def test_core_budget_hands_back_a_token_reclaimed_during_recovery(tmpdir, monkeypatch):
+    """Test that a stale token taken over by a live process between the check and the rename is put back."""
+    import os
+    from deepncli.utils import resources
+    budget = resources.CoreBudget(1, token_folder=str(tmpdir), node_cores=1)
+    token = tmpdir.join('core-0.lock')
+    token.write("999999999")
+
+    def reclaimed(pid):
+        # another process recovers the token first and writes its own (live) pid
+        token.write(str(os.getppid()))
+        return pid == os.getppid()
+
+    monkeypatch.setattr(resources, 'pid_alive', reclaimed)
+    assert not budget._take(str(token))
+    assert token.read() == str(os.getppid())
+    assert tmpdir.listdir(lambda p: '.stale-' in p.basename) == []
+    budget.close()
+
+
+def test_pinning_falls_back_without_psutil_cpu_affinity(monkeypatch):
+    """Test that psutil without cpu_affinity (macOS) does not count as affinity support."""
+    from deepncli.utils import resources
+
+    class Process(object):
+        pass
+
+    monkeypatch.setattr(resources, 'psutil', type('psutil', (object,), {'Process': Process}))
+    monkeypatch.delattr(resources.os, 'sched_setaffinity', raising=False)
+    assert not resources.affinity_supported()
+    resources.set_affinity([0])
+
+
+def test_streaming_api_without_files():
+    """Test that junctions and BLAST hits can be streamed from in-memory lines."""
+    from deepncli import api
+    junction = cli.junction_sequences['hg38']
+    insert = "ATGGCTAGCAAAGGAGAAGAACTTTTCACTGGAGTTGTCCCAATT"
+    reads = ["@HD\tVN:1.0\n",
+             "read1\t4\t*\t0\t0\t*\t*\t0\t0\t%s%s\t*\n" % (junction[10:], insert),
+             "read2\t4\t*\t0\t0\t*\t*\t0\t0\t%s\t*\n" % ("ACGT" * 20)]
+    hits = list(api.iter_junctions(reads, [junction]))
+    assert [(h.read_name, h.downstream, h.mismatches, h.reverse) for h in hits] == [("read1", insert, 0, False)]
+    genes = api.read_gene_list(["NM_1 GENE1 chr1 + 0 0 9 300 EXON ACGT\n"])
+    counts = api.BlastParseCounts()
+    blast = ["# BLASTN 2.7.1+\n", "# 2 hits found\n",
+             "read1\tNM_1\t100.00\t40\t0\t0\t1\t40\t13\t52\t1e-10\t80.0\n",
+             "read1\tNM_1\t99.00\t40\t0\t0\t1\t40\t400\t439\t1e-10\t60.0\n"]
+    blast_hits = list(api.iter_blast_hits(blast, genes, counts))
+    assert [(h.gene, h.position, h.frame, h.orf, h.inframe_inorf) for h in blast_hits] == \
+        [("GENE1", 13, "in_frame", "in_orf", True)]
+    assert (counts.queries, counts.accepted, counts.rejected) == (1, 1, 2)
+
+
+def test_query_finds_gene_by_name_or_nm_number(tmpdir):
+    """Test that gene lookups read the junctions of every sample database, and NM lookups those of one transcript."""
+    from deepncli.db.junctiondb import JunctionsDatabase, Gene, Junction
+    from deepncli.query.main import find_gene_junctions, gene_stats
+    tmpdir.mkdir('blast_results_query')
+    jdb = JunctionsDatabase(str(tmpdir.join('blast_results_query', 'sampleA.db')))
+    jdb.create_tables()
+    gene = Gene.create(gene_name='GENE1', orf_start=10, orf_stop=300, mrna='', intron='EXON', chromosome='chr1',
+                       nm_number='NM_1')
+    Gene.create(gene_name='GENE1', orf_start=10, orf_stop=200, mrna='', intron='EXON', chromosome='chr1',
+                nm_number='NM_2')
+    Junction.create(gene=gene, nm_number='NM_1', position=13, query_start=1, frame='in_frame', orf='in_orf',
+                    inframe_inorf=True, count=3, ppm=30.0)
+    Junction.create(gene=gene, nm_number='NM_2', position=400, query_start=1, frame='not_in_frame', orf='downstream',
+                    inframe_inorf=False, count=1, ppm=10.0)
+    jdb.finalize()
+    jdb.close_db()
+    results, source = find_gene_junctions(str(tmpdir), 'blast_results_query', 'compare', 'GENE1')
+    assert [(p[0], p[1]) for p in results['sampleA']] == [('NM_1', 13), ('NM_2', 400)]
+    stats = gene_stats(results['sampleA'])
+    assert (stats['total'], stats['inframe_inorf'], stats['downstream'], stats['ppm']) == (2, 1, 1, 40.0)
+    for nm_number, position in [('NM_1', 13), ('NM_2', 400)]:
+        results, source = find_gene_junctions(str(tmpdir), 'blast_results_query', 'compare', nm_number)
+        assert [(p[0], p[1]) for p in results['sampleA']] == [(nm_number, position)]
+    assert find_gene_junctions(str(tmpdir), 'blast_results_query', 'compare', 'GENE2')[0]['sampleA'] == []
+    # the experiment store is used until a sample database is newer than it
+    import os
+    import time
+    from deepncli.db.experimentdb import ExperimentDatabase, Sample
+    tmpdir.mkdir('compare')
+    store_path = str(tmpdir.join('compare', 'experiment.db'))
+    edb = ExperimentDatabase(store_path)
+    edb.create_tables()
+    Sample.create(name='sampleA', selected=False, blast_count=40)
+    edb.close_db()
+    os.utime(store_path, (time.time() + 10, time.time() + 10))
+    assert find_gene_junctions(str(tmpdir), 'blast_results_query', 'compare', 'NM_2')[1] == store_path
+    os.utime(store_path, (time.time() - 10, time.time() - 10))
+    results, source = find_gene_junctions(str(tmpdir), 'blast_results_query', 'compare', 'NM_2')
+    assert source == 'blast_results_query' and [(p[0], p[1]) for p in results['sampleA']] == [('NM_2', 400)]
+
+
+def test_preview_samples_a_fraction_of_the_reads(tmpdir):
+    """Test that stride sampling copies whole records and estimates the number of reads."""
+    from deepncli.junction.preview import sample_sam_file, wilson_interval
+    sam = tmpdir.join('sample.sam')
+    sam.write("@HD\tVN:1.0\n" + "".join("read%d\t4\t*\t0\t0\t*\t*\t0\t0\t%s\t*\n" % (i, "ACGT" * 10)
+                                        for i in range(1000, 2000)))
+    sampling = sample_sam_file(str(sam), str(tmpdir.join('preview.sam')), fraction=0.1, windows=10)
+    lines = tmpdir.join('preview.sam').readlines()
+    assert len(lines) == sampling['reads'] and 90 <= sampling['reads'] <= 110
+    assert all(line.startswith('read') and line.endswith("\t*\n") for line in lines)
+    assert sampling['estimated_reads'] == 1000
+    sampling = sample_sam_file(str(sam), str(tmpdir.join('preview.sam')), max_reads=25, windows=10)
+    assert sampling['reads'] == 25
+    # windows starting on a record boundary keep that record, short windows are made up by the next ones
+    sam.write("@HD\tVN:1.0\n" + "".join("read%d\t4\t*\t0\t0\t*\t*\t0\t0\t%s\t*\n" % (i, "ACGT" * 10)
+                                        for i in range(1000, 1100)))
+    for kwargs in [{'fraction': 1.0}, {'max_reads': 100}]:
+        sampling = sample_sam_file(str(sam), str(tmpdir.join('preview.sam')), **kwargs)
+        assert sampling['reads'] == 100 and len(set(tmpdir.join('preview.sam').readlines())) == 100
+    sampling = sample_sam_file(str(sam), str(tmpdir.join('preview.sam')), max_reads=60, windows=40)
+    assert sampling['reads'] == 60
+    low, high = wilson_interval(10, 100)
+    assert low < 0.1 < high and 0.0 < low and high < 1.0
+
+
+def test_detect_junction_from_over_represented_kmers(tmpdir):
+    """Test that the vector/insert junction is assembled from k-mer counts and matched to a known junction."""
+    import random
+    from deepncli.junction.detect import detect_junction
+    random.seed(1)
+    junction = cli.junction_sequences['mm10']
+    records = []
+    for i in range(2000):
+        insert = "".join(random.choice("ACGT") for _ in range(60))
+        sequence = junction[10:] + insert if i % 4 == 0 else "".join(random.choice("ACGT") for _ in range(100))
+        records.append("read%d\t4\t*\t0\t0\t*\t*\t0\t0\t%s\t*\n" % (i, sequence))
+    sam = tmpdir.join('sample.sam')
+    sam.write("".join(records))
+    result = detect_junction(str(sam), cli.junction_sequences, max_reads=1000)
+    assert result['reads'] == 1000
+    assert result['hits']['hg38_pGAD/mm10'] == 250
+    assert result['junction'] == "N" * 10 + junction[10:]
+    assert result['known'] == 'hg38_pGAD/mm10'
+
+
+def test_blast_file_chunks_parse_like_the_whole_file(tmpdir):
+    """Test that chunks split on query headers give the same hits and counts as one pass over the file."""
+    from deepncli import api
+    from deepncli.utils.io import split_on_headers, read_lines
+    from deepncli.junction.aggregate import JunctionCounter
+    genes = api.read_gene_list(["NM_1 GENE1 chr1 + 0 0 9 300 EXON ACGT\n"])
+    blast = []
+    for i in range(200):
+        blast += ["# BLASTN 2.7.1+\n", "# Query: read%d\n" % i, "# 2 hits found\n",
+                  "read%d\tNM_1\t100.00\t40\t0\t0\t1\t40\t%d\t%d\t1e-10\t80.0\n" % (i, 10 + i % 7, 50 + i % 7),
+                  "read%d\tNM_1\t99.00\t40\t0\t0\t1\t40\t400\t439\t1e-10\t79.0\n" % i]
+    path = tmpdir.join('sample.blast.txt')
+    path.write("".join(blast))
+    chunks = split_on_headers(str(path), "# BLASTN", 4, min_chunk_bytes=1)
+    assert len(chunks) == 4 and chunks[0][0] == 0 and chunks[-1][1] == path.size()
+    whole = JunctionCounter()
+    for hit in api.iter_blast_hits(blast, genes):
+        whole.add(hit.nm_number, hit.frame, hit.orf, hit.position, hit.query_start)
+    merged = JunctionCounter()
+    queries = 0
+    for start, end in chunks:
+        counts = api.BlastParseCounts()
+        chunk_counter = JunctionCounter()
+        for hit in api.iter_blast_hits(read_lines(str(path), start, end), genes, counts):
+            chunk_counter.add(hit.nm_number, hit.frame, hit.orf, hit.position, hit.query_start)
+        merged.merge(chunk_counter)
+        queries += counts.queries
+    assert queries == 200
+    assert [whole.decode(k) + (c,) for k, c in whole.items()] == [merged.decode(k) + (c,) for k, c in merged.items()]
+
+
+def test_follow_lines_reads_a_growing_file(tmpdir):
+    """Test that a file still being written is read as complete lines until it stops growing."""
+    import threading
+    import time
+    from deepncli.utils.io import follow_lines
+    path = tmpdir.join('growing.sam')
+    path.write("read1\t4\t*\n" + "read2\t4")
+
+    def append():
+        time.sleep(0.2)
+        with open(str(path), 'a') as handle:
+            handle.write("\t*\nread3\t4\t*\n")
+
+    writer = threading.Thread(target=append)
+    writer.start()
+    with open(str(path)) as handle:
+        lines = list(follow_lines(handle, follow_timeout=0.5, poll_interval=0.05))
+    writer.join()
+    assert lines == ["read1\t4\t*\n", "read2\t4\t*\n", "read3\t4\t*\n"]
+
+
+def test_packed_engine_finds_the_same_junctions():
+    """Test that screening reads in NumPy batches passes on every read the text engine finds a junction in."""
+    pytest.importorskip('numpy')
+    import random
+    from deepncli import api
+    from deepncli.junction.proteinprocessor import ProteinProcessor
+    random.seed(3)
+    junction = cli.junction_sequences['hg38']
+    reads = ["@HD\tVN:1.0\n"]
+    for i in range(3000):
+        insert = "".join(random.choice("ACGTN") for _ in range(random.randint(40, 70)))
+        sequence = list(junction[random.randint(0, 20):] + insert)
+        if i % 3 == 0:
+            sequence[random.randint(0, 25)] = random.choice("ACGTN")
+        sequence = "".join(sequence)
+        if i % 5 == 0:
+            sequence = ProteinProcessor().reverse_complement(sequence)
+        if i % 2 == 0:
+            sequence = "".join(random.choice("ACGT") for _ in range(90))
+        reads.append("read%d\t4\t*\t0\t0\t*\t*\t0\t0\t%s\t*\n" % (i, sequence))
+    for max_mismatches in [0, 2]:
+        text = [h.junction_line() for h in api.iter_junctions(reads, [junction], max_mismatches=max_mismatches)]
+        packed = [h.junction_line() for h in api.iter_junctions(reads, [junction], max_mismatches=max_mismatches,
+                                                                engine='packed')]
+        assert len(text) > 500 and packed == text
+
+
+def test_packed_engine_without_numpy_raises_import_error(monkeypatch):
+    """Test that the packed engine tells what is missing when numpy is not installed."""
+    from deepncli import api
+    from deepncli.junction import packed
+    monkeypatch.setattr(packed, 'np', None)
+    with pytest.raises(ImportError):
+        list(api.iter_junctions(["@HD\tVN:1.0\n"], [cli.junction_sequences['hg38']], engine='packed'))
+
+
+def test_server_answers_requests_and_times_job_stages(tmpdir):
+    """Test the JSON requests of `deepn serve` over its socket and the per-stage timing of finished jobs."""
+    import threading
+    from deepncli.junction import server
+    socket_path = str(tmpdir.join('deepn.sock'))
+    assert not server.server_running(socket_path)
+    daemon = server.DeepnServer(socket_path, 1, None, {})
+    serving = threading.Thread(target=daemon.serve_forever)
+    serving.start()
+    try:
+        assert server.send_command(socket_path, 'ping')['workers'] == 1
+        refused = server.send_command(socket_path, 'submit', directory=str(tmpdir.join('missing')), settings={},
+                                      files=['sample.sam'])
+        assert not refused['ok'] and 'does not exist' in refused['error']
+        assert not server.send_command(socket_path, 'unknown')['ok']
+        job_id = daemon.jobs.add(str(tmpdir), 'sample.sam')
+        daemon.jobs.finish(job_id, {'junctions': 1}, None, [('search', 10.0), ('blast', 12.5), ('parse', 13.0)])
+        job = server.send_command(socket_path, 'status', jobs=[job_id])['jobs'][0]
+        assert job['state'] == 'done' and [stage for stage, seconds in job['stages']] == ['search', 'blast', 'parse']
+        assert job['stages'][:2] == [['search', 2.5], ['blast', 0.5]]
+        assert server.send_command(socket_path, 'shutdown')['ok']
+    finally:
+        serving.join()
+        daemon.close()
+    assert not tmpdir.join('deepn.sock').exists()
+
+
+def test_tiered_blast_merges_missed_queries_in_query_order(tmpdir):
+    """Test that queries without an accepted first pass hit are replaced by their sensitive pass blocks."""
+    from deepncli.junction import tiered
+
+    def blast_output(hits):
+        lines = []
+        for query, identity in hits:
+            lines += ["# BLASTN 2.7.1+\n", "# Query: %s\n" % query, "# %d hits found\n" % (identity > 0)]
+            if identity:
+                lines.append("%s\tNM_1\t%.2f\t40\t0\t0\t1\t40\t100\t139\t1e-10\t80.0\n" % (query, identity))
+        return "".join(lines) + "# BLAST processed %d queries\n" % len(hits)
+
+    first = tmpdir.join('sample.first_pass.out')
+    first.write(blast_output([('read1', 100.0), ('read2', 0), ('read3', 95.0), ('read4', 99.5)]))
+    assert tiered.missed_queries(str(first)) == [1, 2]
+    fasta = tmpdir.join('sample.junctions.fa')
+    fasta.write("".join(">read%d\nACGT\n" % i for i in range(1, 5)))
+    tiered.write_queries(str(fasta), str(tmpdir.join('sample.misses.fasta')), [1, 2])
+    assert tmpdir.join('sample.misses.fasta').read() == ">read2\nACGT\n>read3\nACGT\n"
+    misses = tmpdir.join('sample.misses.out')
+    misses.write(blast_output([('read2', 99.0), ('read3', 95.0)]))
+    merged = tmpdir.join('sample.blast.txt')
+    assert tiered.merge_blast_outputs(str(first), str(misses), str(merged)) == 4
+    single = tmpdir.join('sample.single_pass.out')
+    single.write(blast_output([('read1', 100.0), ('read2', 99.0), ('read3', 95.0), ('read4', 99.5)]))
+    assert merged.read() == single.read()
+    counts, differences = tiered.compare_passes(str(merged), str(single))
+    assert counts['same_queries'] == 4 and counts['same_hits'] == counts['single_hits'] == 3 and not differences
+
+    # unmapped mates share a read name: only the second one is missed and gets its own sensitive hit
+    first.write(blast_output([('X', 100.0), ('X', 0)]))
+    assert tiered.missed_queries(str(first)) == [1]
+    fasta.write(">X\nAAAA\n>X\nCCCC\n")
+    tiered.write_queries(str(fasta), str(tmpdir.join('sample.misses.fasta')), [1])
+    assert tmpdir.join('sample.misses.fasta').read() == ">X\nCCCC\n"
+    misses.write(blast_output([('X', 99.0)]).replace("\t100\t139\t", "\t500\t539\t"))
+    assert tiered.merge_blast_outputs(str(first), str(misses), str(merged)) == 2
+    assert [hits for query, hits in tiered.accepted_by_query(str(merged))] == [(('NM_1', 100, 1),),
+                                                                               (('NM_1', 500, 1),)]
+    # a sensitive block that was not asked for is an error, not dropped
+    misses.write(blast_output([('X', 99.0), ('X', 98.0)]))
+    with pytest.raises(ValueError):
+        tiered.merge_blast_outputs(str(first), str(misses), str(merged))
+
+
+def test_single_pass_search_writes_the_fasta_of_the_junction_file(tmpdir):
+    """Test that the FASTA written during the search matches the one converted from the (compressed) junction file."""
+    import gzip
+    import random
+    from deepncli.api import make_search_junctions
+    from deepncli.utils.io import open_output, compression_available, compression_suffixes
+    from deepncli.junction.main import search_for_junctions
+    random.seed(5)
+    junction = cli.junction_sequences['hg38']
+    reads = ["@HD\tVN:1.0\n"]
+    for i in range(300):
+        insert = "".join(random.choice("ACGT") for _ in range(60))
+        sequence = junction[random.randint(0, 20):] + insert if i % 2 else insert + insert
+        reads.append("read%d\t4\t*\t0\t0\t*\t*\t0\t0\t%s\t*\n" % (i, sequence))
+    sam = tmpdir.join('sample.sam')
+    sam.write("".join(reads))
+    for compression in ['none', 'gzip'] + (['zstd'] if compression_available('zstd') else []):
+        junction_path = str(tmpdir.join('sample.%s.junctions.txt' % compression))
+        fasta_path = tmpdir.join('sample.%s.junctions.fa' % compression)
+        output_handle = open_output(junction_path, compression)
+        fasta_handle = open(str(fasta_path), 'w')
+        hits = search_for_junctions(str(sam), make_search_junctions([junction]), "", output_handle, 0, fasta_handle)
+        output_handle.close()
+        fasta_handle.close()
+        junction_path += compression_suffixes[compression]
+        if compression == 'gzip':
+            junction_lines = gzip.open(junction_path).read().decode('utf-8').splitlines()
+        elif compression == 'zstd':
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(open(junction_path, 'rb').read())
+            junction_lines = data.decode('utf-8').splitlines()
+        else:
+            junction_lines = open(junction_path).read().splitlines()
+        # the records make_fasta_file converted from the junction file before the FASTA was written in the search
+        converted = "".join(">%s\n%s\n" % (line.split()[0], line.split()[5]) for line in junction_lines)
+        assert hits == 150 and len(junction_lines) == hits and fasta_path.read() == converted
+
+
+def test_compare_writes_ppm_matrices_with_enrichment(tmpdir):
+    """Test the gene and junction ppm matrices of two samples, one of them written before the summary table."""
+    import sqlite3
+    from deepncli.db.junctiondb import JunctionsDatabase, Gene, Junction, Summary
+    from deepncli.compare.main import compare_samples
+    tmpdir.mkdir('blast_results_query')
+    tmpdir.mkdir('compare')
+    jdb = JunctionsDatabase(str(tmpdir.join('blast_results_query', 'sampleA.db')))
+    jdb.create_tables()
+    gene = Gene.create(gene_name='GENE1', orf_start=10, orf_stop=300, mrna='', intron='EXON', chromosome='chr1',
+                       nm_number='NM_1')
+    Gene.create(gene_name='GENE1', orf_start=10, orf_stop=200, mrna='', intron='EXON', chromosome='chr1',
+                nm_number='NM_2')
+    Junction.create(gene=gene, nm_number='NM_2', position=13, query_start=1, frame='in_frame', orf='in_orf',
+                    inframe_inorf=True, count=2, ppm=20000.0)
+    Summary.insert(blast_count=100, accepted_count=2, rejected_count=0).execute()
+    jdb.finalize()
+    jdb.close_db()
+    # a database of an older release: no summary table and no NM number on the junctions
+    legacy = sqlite3.connect(str(tmpdir.join('blast_results_query', 'sampleB.db')))
+    legacy.executescript("CREATE TABLE gene (id INTEGER PRIMARY KEY, gene_name TEXT, orf_start INTEGER, "
+                         "orf_stop INTEGER, mrna TEXT, intron TEXT, chromosome TEXT, nm_number TEXT);"
+                         "CREATE TABLE junction (id INTEGER PRIMARY KEY, gene_id INTEGER, position INTEGER, "
+                         "query_start INTEGER, frame TEXT, ppm REAL, orf TEXT, inframe_inorf INTEGER, count INTEGER);"
+                         "INSERT INTO gene VALUES (1, 'GENE1', 10, 300, '', 'EXON', 'chr1', 'NM_1');"
+                         "INSERT INTO junction VALUES (1, 1, 13, 1, 'in_frame', 20000.0, 'in_orf', 1, 4);")
+    legacy.commit()
+    legacy.close()
+    compare_samples(str(tmpdir), 'blast_results_query', 'compare', ['sampleA'], 1.0)
+    gene_rows = [line.split("\t") for line in tmpdir.join('compare', 'gene_ppm.txt').read().splitlines()]
+    assert gene_rows[0] == ['gene_name', 'sampleA', 'sampleB', 'selected_ppm', 'non_selected_ppm', 'enrichment']
+    # sampleB holds 4 reads at 20000 ppm, so its blast_count of 200 is recovered from the ppm
+    assert gene_rows[1] == ['GENE1', '20000.0000', '20000.0000', '20000.0000', '20000.0000', '1.0000']
+    junction_rows = [line.split("\t") for line in tmpdir.join('compare', 'junction_ppm.txt').read().splitlines()]
+    assert [row[:2] + row[6:8] for row in junction_rows[1:]] == [['GENE1', 'NM_1', '0.0000', '20000.0000'],
+                                                                 ['GENE1', 'NM_2', '20000.0000', '0.0000']]
+    assert "%.4f" % ((0.0 + 1.0) / (20000.0 + 1.0)) == junction_rows[1][-1]
+
+
+def test_parse_chunks_return_spilled_runs_that_merge_like_one_pass(tmpdir):
+    """Test that chunk workers hand back only spill files and counts, and the merged database matches one pass."""
+    import sqlite3
+    from deepncli.utils.io import split_on_headers
+    from deepncli.junction.main import parse_blast_chunk, write_junctions
+    gene_list = tmpdir.join('genes.prn')
+    gene_list.write("".join("NM_%d GENE%d chr1 + 0 0 9 300 EXON ACGT\n" % (i, i // 2) for i in range(6)))
+    blast = []
+    for i in range(300):
+        blast += ["# BLASTN 2.7.1+\n", "# Query: read%d\n" % i, "# 1 hits found\n",
+                  "read%d\tNM_%d\t100.00\t40\t0\t0\t1\t40\t%d\t%d\t1e-10\t80.0\n" % (i, i % 6, 10 + i % 7, 50 + i % 7)]
+    path = tmpdir.join('sample.blast.txt')
+    path.write("".join(blast))
+    tmpdir.mkdir('query')
+    spill_directory = str(tmpdir.join('query'))
+    databases = []
+    for chunks in [1, 4]:
+        chunk_results = [parse_blast_chunk(str(path), start, end, str(gene_list), 1024, spill_directory)
+                         for start, end in split_on_headers(str(path), "# BLASTN", chunks, min_chunk_bytes=1)]
+        assert len(chunk_results) == chunks
+        assert all(isinstance(spill_file, str) for spill_files, counts in chunk_results for spill_file in spill_files)
+        name = 'chunks%d.blast.txt' % chunks
+        assert write_junctions(str(tmpdir), name, 'query', str(gene_list), chunk_results) == (300, 300)
+        db = sqlite3.connect(str(tmpdir.join('query', name.replace('.blast.txt', '.db'))))
+        databases.append(sorted(db.execute("SELECT nm_number, position, query_start, frame, orf, count, ppm "
+                                           "FROM junction")))
+        db.close()
+    assert len(databases[0]) == 42 and databases[0] == databases[1]
+    assert sorted(f.basename for f in tmpdir.join('query').listdir()) == ['chunks1.db', 'chunks4.db']